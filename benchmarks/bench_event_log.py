@@ -0,0 +1,40 @@
+"""
+Compares the size and load time of the JSONL and binary event history formats.
+
+Usage: python benchmarks/bench_event_log.py [n_events]
+
+Runs against a scratch LCTRACK_DATA_DIR, so the real lc-track data is never touched.
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+os.environ["LCTRACK_DATA_DIR"] = tempfile.mkdtemp(prefix="lctrack-bench-")
+
+from pathlib import Path
+from lctrack import backup
+from synthetic import generate_events
+
+def main(n_events : int) -> None:
+    data_dir = Path(os.environ["LCTRACK_DATA_DIR"])
+    events = generate_events(n_events)
+
+    print(f"{'format':>8} {'size (MB)':>10} {'load (s)':>10} {'tail read (s)':>14}")
+    for fmt in [backup.JSONL, backup.BINARY]:
+        path = data_dir / f"events.{fmt}"
+        backup.write_event_history(path, events, fmt)
+
+        start = time.perf_counter()
+        assert backup.load_event_history(path) == events
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backup.read_event_history_tail(path)
+        tail = time.perf_counter() - start
+
+        print(f"{fmt:>8} {path.stat().st_size / 1e6:>10.1f} {load:>10.3f} {tail:>14.3f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
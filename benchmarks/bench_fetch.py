@@ -0,0 +1,39 @@
+"""
+Times lc_client.fetch_all_problems against the local stand-in server (fake_leetcode.py),
+sequentially (1 worker) and concurrently, and checks the pages come back complete and in order.
+
+Usage: python benchmarks/bench_fetch.py [--problems 3500] [--latency 0.2] [--failure-rate 0.05]
+"""
+
+import time
+import argparse
+
+from lctrack import lc_client
+from fake_leetcode import FakeLeetCode, make_catalogue
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problems", type=int, default=3500)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    # Keep the retries quick, the backoff itself isn't what is being measured
+    lc_client.BACKOFF_BASE = 0.05
+
+    catalogue = make_catalogue(args.problems)
+    server = FakeLeetCode(catalogue, args.latency, args.failure_rate).start()
+
+    print(f"{args.problems} problems, {args.latency * 1000:.0f} ms latency, {args.failure_rate:.0%} failed requests")
+    for workers in [1, lc_client.MAX_WORKERS]:
+        server.requests = 0
+        start = time.perf_counter()
+        problems = lc_client.fetch_all_problems(server.url, max_workers=workers)
+        elapsed = time.perf_counter() - start
+
+        print(f"{workers:>2} worker(s): {elapsed:6.2f} s, {server.requests} requests, complete and in order: {problems == catalogue}")
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Times sm2.SM2_entry_states, with each backend, on synthetic entries, and checks that both
+backends give identical results.
+
+Usage: python benchmarks/bench_sm2.py [n_entries] [n_problems]
+       python benchmarks/bench_sm2.py crossover
+
+crossover times both backends over a grid of history sizes and problem counts, next to the
+backend sm2.numpy_pays_off picks for each, to show (and tune) where NumPy starts to win.
+"""
+
+import sys
+import time
+import random
+from collections import Counter
+
+from lctrack import sm2
+
+def generate_entries(n_entries : int, n_problems : int, seed : int = 0):
+    rng = random.Random(seed)
+    return [
+        (rng.randint(1, n_problems), rng.randint(0, 5), 1_600_000_000 + rng.randint(0, 10**8))
+        for _ in range(n_entries)
+    ]
+
+def group_entries(entries):
+    """ Sorts entries (problem_id, confidence, ts) by problem, then chronologically, into the
+    grouped (problem_ids, confidences) arrays taken by SM2_entry_states.
+    """
+    ordered = sorted(entries, key=lambda x : (x[0], x[2]))
+    return [x[0] for x in ordered], [x[1] for x in ordered]
+
+def main(n_entries : int, n_problems : int) -> None:
+    start = time.perf_counter()
+    grouped = group_entries(generate_entries(n_entries, n_problems))
+    print(f"{n_entries} entries across {n_problems} problems (generated and grouped in {time.perf_counter() - start:.2f} s)")
+
+    backends = ["python"] + (["numpy"] if sm2.HAVE_NUMPY else [])
+    results = {}
+    for backend in backends:
+        start = time.perf_counter()
+        results[backend] = sm2.SM2_entry_states(*grouped, backend=backend)
+        elapsed = time.perf_counter() - start
+        print(f"{backend:>8}: {elapsed:.3f} s ({n_entries / elapsed:,.0f} entries/s)")
+
+    if len(results) > 1:
+        print(f"identical: {results['python'] == results['numpy']}")
+
+def best_of(fn, repeat : int = 3) -> float:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+def crossover() -> None:
+    if not sm2.HAVE_NUMPY:
+        print("numpy isn't installed, so there is only the python backend")
+        return
+
+    # Timed separately, as it is paid once per process by the first NumPy call
+    start = time.perf_counter()
+    sm2.SM2_entry_states([1], [5], backend="numpy")
+    print(f"numpy import: {time.perf_counter() - start:.3f} s")
+
+    print(f"{'entries':>9} {'problems':>9} {'per step':>9} {'python (s)':>11} {'numpy (s)':>10} {'auto':>7}")
+    for n_entries in [10_000, 100_000, 1_000_000]:
+        for n_problems in [30, 100, 300, 1_000, 3_000, 10_000]:
+            problem_ids, confidences = group_entries(generate_entries(n_entries, n_problems))
+            per_step = n_entries / max(Counter(problem_ids).values())
+
+            python = best_of(lambda: sm2.SM2_entry_states(problem_ids, confidences, backend="python"))
+            numpy = best_of(lambda: sm2.SM2_entry_states(problem_ids, confidences, backend="numpy"))
+            auto = "numpy" if sm2.numpy_pays_off(problem_ids) else "python"
+            print(f"{n_entries:>9} {n_problems:>9} {per_step:>9.0f} {python:>11.4f} {numpy:>10.4f} {auto:>7}")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["crossover"]:
+        crossover()
+        sys.exit(0)
+
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_problems = int(sys.argv[2]) if len(sys.argv) > 2 else 3_000
+    main(n_entries, n_problems)
@@ -0,0 +1,95 @@
+"""
+Fails (exit code 1) if a removed entry's ADD_ENTRY comes back into a compacted local event
+history, e.g. when a sync merges in new events from another device, as the backup's segments
+(which are never rewritten) still hold it.
+
+Two devices, each with a scratch LCTRACK_DATA_DIR, sync through a local bare repository, by
+running the real sync command (with the remote's url pointed at the bare repository).
+
+Usage: python benchmarks/check_compaction.py
+"""
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+from pathlib import Path
+
+if "--device" not in sys.argv:
+    os.environ["LCTRACK_DATA_DIR"] = tempfile.mkdtemp(prefix="lctrack-bench-")
+
+from lctrack.constants import LOCAL_EVENT_HISTORY
+
+def run(data_dir : Path, remote : Path, *args : str) -> str:
+    """ Runs an lc-track command as the device with the given data dir. """
+    env = dict(os.environ, LCTRACK_DATA_DIR=str(data_dir))
+    result = subprocess.run([sys.executable, __file__, "--device", str(remote), *args],
+                            env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"lc-track {' '.join(args)} failed:\n{result.stdout}{result.stderr}")
+    return result.stdout
+
+def device(remote : str, args : list) -> int:
+    """ Runs the command in this process, as a device set up to sync with the bare repository. """
+    import git
+    from typer.testing import CliRunner
+    from lctrack import access, cli, utility
+    from lctrack.constants import BACKUP_REPO_DIR
+
+    if not access.db_exists():
+        access.init_db()
+        utility.load_catalogue_snapshot()
+
+    # Marking the (LC250) catalogue complete keeps sync from fetching the rest from leetcode.com
+    with access.transaction() as con:
+        for key, value in [("SYNC_SETUP", "SUCCESS"), ("PAT", "-"), ("USERNAME", "-"), ("BACKUP_REPO_NAME", "-"),
+                           ("initial_sync", "complete")]:
+            access.set_state(con, key, value)
+
+    # Sync points the clone at github.com, keep it on the bare repository instead
+    if not access.check_repo(BACKUP_REPO_DIR):
+        git.Repo.clone_from(remote, BACKUP_REPO_DIR)
+    git.Remote.set_url = lambda self, *args, **kwargs: None
+
+    result = CliRunner().invoke(cli.app, args)
+    print(result.output, end="")
+    return result.exit_code
+
+def count_adds(data_dir : Path, entry_uuid : str) -> int:
+    history = data_dir / LOCAL_EVENT_HISTORY.name
+    events = [json.loads(x) for x in history.read_text().splitlines() if x.strip()]
+    return sum(x["event"] == "ADD_ENTRY" and x["id"] == entry_uuid for x in events)
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="lctrack-compaction-"))
+    remote, a, b = tmp / "remote.git", tmp / "a", tmp / "b"
+    subprocess.run(["git", "init", "-q", "--bare", "-b", "main", str(remote)], check=True)
+
+    # A logs two entries, backs them up, then removes one and compacts
+    removed = run(a, remote, "add-entry", "1", "--confidence", "4").split("[ID: ")[1].split("]")[0]
+    run(a, remote, "add-entry", "2", "--confidence", "3")
+    run(a, remote, "sync")
+    run(a, remote, "rm-entry", removed)
+    run(a, remote, "sync")
+    run(a, remote, "compact")
+
+    # B picks up the backup, and adds an event of its own, so A's next sync merges
+    run(b, remote, "sync")
+    run(b, remote, "add-entry", "3", "--confidence", "5")
+    run(b, remote, "sync")
+    run(a, remote, "sync")
+
+    failures = 0
+    for name, data_dir in [("a", a), ("b", b)]:
+        adds = count_adds(data_dir, removed)
+        status = "FAIL" if adds else "ok"
+        print(f"{status:<5} device {name}: {adds} ADD_ENTRY events of the removed entry")
+        failures += bool(adds)
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--device":
+        sys.exit(device(sys.argv[2], sys.argv[3:]))
+    sys.exit(main())
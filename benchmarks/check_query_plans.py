@@ -0,0 +1,94 @@
+"""
+Fails (exit code 1) if any of the statements run by the hot paths below goes back to a full
+table scan, e.g. because an index was dropped from access.SCHEMA_UPGRADES or a query was rewritten.
+
+The statements are captured (with their parameters bound, via the connection's trace callback)
+while the real access / scheduler functions run, so the check follows any change to their SQL.
+
+Usage: python benchmarks/check_query_plans.py
+
+Runs against a scratch LCTRACK_DATA_DIR, so the real lc-track data is never touched.
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ["LCTRACK_DATA_DIR"] = tempfile.mkdtemp(prefix="lctrack-bench-")
+
+from lctrack import access, scheduler, utility
+
+CATALOGUE = Path(__file__).resolve().parent.parent / "LC250.csv"
+
+def restate_back_dated() -> None:
+    # Inserting before the latest entry replays from the previous entry's cached state
+    access.insert_entry("check-2", 1, 3, 1_600_000_500)
+
+# name -> function running the hot path
+HOT_PATHS = {
+    "access.get_for_review_problems": access.get_for_review_problems,
+    "scheduler.count_due": scheduler.count_due,
+    "scheduler.review_queue": lambda: scheduler.review_queue(limit=10),
+    "scheduler.plan": lambda: scheduler.plan(30),
+    "scheduler.forecast": lambda: scheduler.forecast(14),
+    "access.get_all_entries_by_problem_id": lambda: access.get_all_entries_by_problem_id(1),
+    "access.insert_entry": lambda: access.insert_entry("check-1", 1, 4, 1_600_001_000),
+    "access.insert_entry (back dated)": restate_back_dated,
+    "access.rm_entry": lambda: access.rm_entry("check-2"),
+}
+
+def setup() -> None:
+    access.init_db()
+    with access.transaction() as con:
+        access.upsert_catalogue(con, *utility.read_problem_csv(CATALOGUE))
+        con.execute("UPDATE problems SET active = 1 WHERE id <= 50")
+    access.insert_entry("check-0", 1, 5, 1_600_000_000)
+
+def capture_statements(fn) -> list:
+    """ Runs fn, returning the distinct statements it ran on the process-wide connection. """
+    con = access.get_db_connection()
+    statements = []
+
+    def record(statement : str) -> None:
+        # Leaves out transaction control, and the statements run by triggers ("-- TRIGGER ...")
+        if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE"):
+            if statement not in statements:
+                statements.append(statement)
+
+    con.set_trace_callback(record)
+    try:
+        fn()
+    finally:
+        con.set_trace_callback(None)
+
+    return statements
+
+def full_scans(query : str) -> list:
+    con = access.get_db_connection()
+    plan = con.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+
+    # Each row is (id, parent, notused, detail), e.g. detail = "SCAN problems". Scans of
+    # virtual tables (json_each, the FTS index) are lookups by their own index.
+    return [row[3] for row in plan if row[3].startswith("SCAN") and "VIRTUAL TABLE" not in row[3]]
+
+def main() -> int:
+    setup()
+
+    failures = 0
+    for name, fn in HOT_PATHS.items():
+        statements = capture_statements(fn)
+        if not statements:
+            print(f"FAIL  {name}: ran no statements")
+            failures += 1
+            continue
+
+        scans = [f"{' '.join(x.split())[:80]}: {detail}" for x in statements for detail in full_scans(x)]
+        status = "FAIL" if scans else "ok"
+        print(f"{status:<5} {name} ({len(statements)} statements)" + "".join(f"\n      {x}" for x in scans))
+        failures += bool(scans)
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
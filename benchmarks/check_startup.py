@@ -0,0 +1,87 @@
+"""
+Startup budget for the CLI. Fails (exit code 1) if:
+- importing lctrack.cli pulls in any of LAZY_MODULES (measured with python -X importtime), or
+- `lc-track ls-review` takes more than --budget-ms longer than a bare interpreter start.
+
+Usage: python benchmarks/check_startup.py [--budget-ms 150] [--runs 5]
+
+Runs against a scratch LCTRACK_DATA_DIR, so the real lc-track data is never touched.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Only the commands that use these should pay for importing them
+LAZY_MODULES = ["git", "github", "requests", "numpy", "lctrack.lc_client"]
+
+def importtime(module : str, env : dict) -> dict:
+    """ Returns module -> cumulative import time (us) for everything imported by `import module`. """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True, check=True
+    )
+
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+
+    return times
+
+def best_wall_time(cmd : list, env : dict, runs : int) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, capture_output=True, check=True)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def setup_data_dir(env : dict) -> None:
+    """ A database past its first run, so no catalogue fetch is triggered. """
+    subprocess.run([sys.executable, "-c", """
+from lctrack import access
+access.init_db()
+with access.transaction() as con:
+    access.set_state(con, "initial_sync", "complete")
+"""], env=env, check=True)
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=150)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(os.environ, LCTRACK_DATA_DIR=tempfile.mkdtemp(prefix="lctrack-bench-"))
+    setup_data_dir(env)
+
+    failed = False
+
+    times = importtime("lctrack.cli", env)
+    eager = [m for m in LAZY_MODULES if m in times]
+    print(f"import lctrack.cli: {times.get('lctrack.cli', 0) / 1000:.1f} ms")
+    if eager:
+        print(f"FAIL  imported at startup: {', '.join(eager)}")
+        failed = True
+
+    interpreter = best_wall_time([sys.executable, "-c", "pass"], env, args.runs)
+    ls_review = best_wall_time([sys.executable, "-m", "lctrack.cli", "ls-review"], env, args.runs)
+    overhead_ms = (ls_review - interpreter) * 1000
+
+    print(f"interpreter start: {interpreter * 1000:.1f} ms")
+    print(f"lc-track ls-review: {ls_review * 1000:.1f} ms (+{overhead_ms:.1f} ms, budget {args.budget_ms:.0f} ms)")
+    if overhead_ms > args.budget_ms:
+        print("FAIL  ls-review is over the startup budget")
+        failed = True
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
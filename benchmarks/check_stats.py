@@ -0,0 +1,57 @@
+"""
+Fails (exit code 1) if the stats tables, as kept current by the triggers of access.STATS_TRIGGERS
+through many entry inserts and removals, differ from a recompute from scratch (e.g. because a sum
+drifts, or a trigger misses a change).
+
+Usage: python benchmarks/check_stats.py [n_changes]
+
+Runs against a scratch LCTRACK_DATA_DIR, so the real lc-track data is never touched.
+"""
+
+import os
+import sys
+import uuid
+import random
+import tempfile
+from pathlib import Path
+
+os.environ["LCTRACK_DATA_DIR"] = tempfile.mkdtemp(prefix="lctrack-bench-")
+
+from lctrack import access, utility
+
+CATALOGUE = Path(__file__).resolve().parent.parent / "LC250.csv"
+
+def stats_rows() -> list:
+    con = access.get_db_connection()
+    return [con.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall() for table in access.STATS_TABLES]
+
+def main(n_changes : int) -> int:
+    access.init_db()
+    with access.transaction() as con:
+        access.upsert_catalogue(con, *utility.read_problem_csv(CATALOGUE))
+
+    # Few problems, so each sees many rm / re-add cycles
+    problem_ids = [x[0] for x in access.get_db_connection().execute("SELECT id FROM problems LIMIT 20")]
+    rng = random.Random(0)
+    live = []
+    for _ in range(n_changes):
+        if live and rng.random() < 0.4:
+            access.rm_entry(live.pop(rng.randrange(len(live))))
+        else:
+            entry_uuid = str(uuid.uuid4())
+            access.insert_entry(entry_uuid, rng.choice(problem_ids), rng.randint(0, 5), 1_600_000_000 + rng.randint(0, 10**7))
+            live.append(entry_uuid)
+
+    kept = stats_rows()
+    with access.transaction() as con:
+        access.recompute_stats(con)
+
+    if kept != stats_rows():
+        print(f"FAIL  stats kept by the triggers differ from a recompute after {n_changes} changes")
+        return 1
+
+    print(f"ok    stats kept by the triggers match a recompute after {n_changes} changes")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5_000))
@@ -0,0 +1,91 @@
+"""
+A local stand-in for the leetcode.com GraphQL questionList endpoint, serving a synthetic
+catalogue, so lc_client can be exercised and benchmarked offline.
+
+Usage: python benchmarks/fake_leetcode.py [--problems 3500] [--latency 0.2] [--failure-rate 0.0] [--port 8765]
+Then: LCTRACK_GRAPHQL_URL=http://127.0.0.1:8765/graphql/ lc-track ...
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DIFFICULTIES = ["Easy", "Medium", "Hard"]
+TOPICS = [("array", "Array"), ("string", "String"), ("hash-table", "Hash Table"),
+          ("dynamic-programming", "Dynamic Programming"), ("graph", "Graph"), ("tree", "Tree")]
+
+def make_catalogue(n_problems : int, seed : int = 0) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            "questionFrontendId": str(i),
+            "title": f"Problem {i}",
+            "titleSlug": f"problem-{i}",
+            "difficulty": rng.choice(DIFFICULTIES),
+            "topicTags": [{"slug": slug, "name": name} for slug, name in rng.sample(TOPICS, rng.randint(1, 3))],
+        }
+        for i in range(1, n_problems + 1)
+    ]
+
+class FakeLeetCode(ThreadingHTTPServer):
+    """ Serves questionList pages of catalogue, after `latency` seconds, failing a
+    `failure_rate` fraction of requests with a 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, catalogue : list, latency : float = 0.0, failure_rate : float = 0.0, port : int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/graphql/"
+
+    def start(self) -> "FakeLeetCode":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        time.sleep(server.latency)
+        if random.random() < server.failure_rate:
+            self.send_error(503)
+            return
+
+        variables = body["variables"]
+        skip, limit = variables["skip"], variables["limit"]
+        payload = json.dumps({"data": {"problemsetQuestionList": {
+            "totalNum": len(server.catalogue),
+            "questions": server.catalogue[skip:skip + limit],
+        }}}).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problems", type=int, default=3500)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = FakeLeetCode(make_catalogue(args.problems), args.latency, args.failure_rate, args.port)
+    print(f"Serving {args.problems} problems on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,223 @@
+"""
+Benchmark suite for the operations that slow down as the event history grows: replaying the
+history (sync's rebuild), merging histories, the review queue queries, rm-entry and CLI cold start.
+
+Usage:
+    python benchmarks/run.py [--cases replay,merge] [--sizes 10000,100000,1000000] [--repeat 3]
+                             [--output results.json] [--baseline old-results.json] [--threshold 1.25]
+
+Every (case, size) pair runs in its own process against a fresh scratch LCTRACK_DATA_DIR, so the
+real lc-track data is never touched and no run sees another's caches. Each reports the best of
+--repeat timings.
+
+--output writes the results (and the commit, python and sqlite versions they were taken with) as
+JSON. --baseline compares against an earlier --output file, and exits with code 1 if any case got
+slower than its threshold allows.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+from pathlib import Path
+
+SIZES = [10_000, 100_000]
+REPEAT = 3
+
+# Allowed slowdown (new / baseline) before a case is flagged as a regression
+THRESHOLD = 1.25
+THRESHOLDS = {
+    "startup": 1.5, # Dominated by process start up, which is noisy
+}
+# Differences smaller than this (seconds) are never flagged, however large the ratio
+MIN_DELTA = 0.005
+
+def timed(fn, repeat : int) -> list:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+
+    return runs
+
+def replayed_history(n_events : int):
+    """ Sets up a data dir whose database has been rebuilt from an n_events long local history. """
+    from lctrack import backup
+    from lctrack.constants import LOCAL_EVENT_HISTORY
+    from synthetic import generate_events, setup_db
+
+    setup_db()
+    backup.write_event_history(LOCAL_EVENT_HISTORY, generate_events(n_events))
+    backup.update_state_from_local_event_history()
+
+def case_replay(n_events : int, repeat : int) -> list:
+    from lctrack import backup
+    from lctrack.constants import LOCAL_EVENT_HISTORY
+    from synthetic import generate_events, setup_db
+
+    setup_db()
+    backup.write_event_history(LOCAL_EVENT_HISTORY, generate_events(n_events))
+
+    # A state snapshot taken by the first run would turn the later ones into snapshot loads
+    backup.SNAPSHOT_INTERVAL = float("inf")
+
+    return timed(backup.update_state_from_local_event_history, repeat)
+
+def case_merge(n_events : int, repeat : int) -> list:
+    """ A backup and a local history that share 80% of their events, as after a sync on another device. """
+    from lctrack import backup
+    from lctrack.constants import DATA_DIR
+    from synthetic import generate_events
+
+    events = generate_events(n_events)
+    a, b = DATA_DIR / "a.jsonl", DATA_DIR / "b.jsonl"
+    backup.write_event_history(a, events[:int(n_events * 0.9)])
+    backup.write_event_history(b, events[int(n_events * 0.1):])
+
+    return timed(lambda: backup.merge_event_histories(a, b, dest=DATA_DIR / "merged.jsonl"), repeat)
+
+def case_review_query(n_events : int, repeat : int) -> list:
+    from lctrack import access
+
+    replayed_history(n_events)
+    with access.transaction() as con:
+        con.execute("UPDATE problems SET active = 1")
+
+    return timed(access.get_for_review_problems, repeat)
+
+def case_review_queue(n_events : int, repeat : int) -> list:
+    """ The 20 most urgent problems, as `ls-review -n 20` / `study` fetch them. """
+    from lctrack import access, scheduler
+
+    replayed_history(n_events)
+    with access.transaction() as con:
+        con.execute("UPDATE problems SET active = 1")
+
+    return timed(lambda: scheduler.review_queue(limit=20), repeat)
+
+def case_rm_entry(n_events : int, repeat : int) -> list:
+    from lctrack import access
+
+    replayed_history(n_events)
+    entry_uuids = [x[0] for x in access.get_all_entries()]
+    targets = iter(random.Random(0).sample(entry_uuids, repeat))
+
+    return timed(lambda: access.rm_entry(next(targets)), repeat)
+
+def case_startup(n_events : int, repeat : int) -> list:
+    replayed_history(n_events)
+    cmd = [sys.executable, "-m", "lctrack.cli", "ls-review"]
+
+    return timed(lambda: subprocess.run(cmd, capture_output=True, check=True), repeat)
+
+CASES = {
+    "replay": case_replay,
+    "merge": case_merge,
+    "review_query": case_review_query,
+    "review_queue": case_review_queue,
+    "rm_entry": case_rm_entry,
+    "startup": case_startup,
+}
+
+def run_case(case : str, n_events : int, repeat : int) -> dict:
+    """ Runs a single case in a child process, against a fresh data dir. """
+    env = dict(os.environ, LCTRACK_DATA_DIR=tempfile.mkdtemp(prefix="lctrack-bench-"))
+    res = subprocess.run(
+        [sys.executable, __file__, "--child", case, str(n_events), str(repeat)],
+        env=env, capture_output=True, text=True
+    )
+    if res.returncode != 0:
+        raise RuntimeError(f"{case}/{n_events} failed:\n{res.stderr}")
+
+    runs = json.loads(res.stdout.splitlines()[-1])
+    return {"case": case, "events": n_events, "seconds": min(runs), "runs": runs}
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+def compare(results : dict, baseline : dict, threshold : float) -> bool:
+    """ Prints each result against its baseline. Returns True if any case regressed. """
+    regressed = False
+
+    print(f"\n{'case':>24} {'baseline (s)':>13} {'now (s)':>10} {'ratio':>7}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        old, new = baseline[key]["seconds"], result["seconds"]
+        ratio = new / old if old else float("inf")
+        limit = THRESHOLDS.get(result["case"], threshold)
+
+        flag = ""
+        if ratio > limit and new - old > MIN_DELTA:
+            flag = f"  REGRESSION (> {limit:.2f}x)"
+            regressed = True
+
+        print(f"{key:>24} {old:>13.4f} {new:>10.4f} {ratio:>6.2f}x{flag}")
+
+    return regressed
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", default=",".join(CASES))
+    parser.add_argument("--sizes", default=",".join(str(x) for x in SIZES))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    cases = args.cases.split(",")
+    unknown = [x for x in cases if x not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}, choose from {', '.join(CASES)}")
+
+    results = {}
+    print(f"{'case':>24} {'best (s)':>10}")
+    for case in cases:
+        for n_events in [int(x) for x in args.sizes.split(",")]:
+            result = run_case(case, n_events, args.repeat)
+            results[f"{case}/{n_events}"] = result
+
+            print(f"{case + '/' + str(n_events):>24} {result['seconds']:>10.4f}")
+
+    if args.output:
+        args.output.write_text(json.dumps({"meta": metadata(), "results": results}, indent=2) + "\n")
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        case, n_events, repeat = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+        print(json.dumps(CASES[case](n_events, repeat)))
+        sys.exit(0)
+
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""
+Synthetic catalogues and event histories for the benchmarks.
+
+Nothing here imports lctrack at module level, as LCTRACK_DATA_DIR has to be set before
+lctrack is first imported (see constants.py), which each benchmark does itself.
+"""
+
+import uuid
+import random
+
+from fake_leetcode import make_catalogue
+
+N_PROBLEMS = 3500 # Roughly the size of the leetcode.com catalogue
+RM_RATIO = 0.05 # Fraction of events that remove an earlier entry
+START_TS = 1_600_000_000
+
+def generate_events(n_events : int, n_problems : int = N_PROBLEMS, rm_ratio : float = RM_RATIO, seed : int = 0) -> list:
+    """ Returns n_events events, sorted by ts, as they would appear in an event history: mostly
+    ADD_ENTRYs spread over n_problems problems, with a rm_ratio fraction of RM_ENTRYs that each
+    remove a random, still live, earlier entry.
+    """
+    rng = random.Random(seed)
+    ts = START_TS
+    live = []
+    events = []
+
+    for _ in range(n_events):
+        ts += rng.randint(1, 3600)
+        if live and rng.random() < rm_ratio:
+            # Swap-remove, so picking a random live entry stays O(1)
+            i = rng.randrange(len(live))
+            live[i], live[-1] = live[-1], live[i]
+            events.append({
+                "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                "event": "RM_ENTRY",
+                "target_entry_uuid": live.pop(),
+                "ts": ts
+            })
+        else:
+            entry_uuid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            live.append(entry_uuid)
+            events.append({
+                "id": entry_uuid,
+                "event": "ADD_ENTRY",
+                "problem_id": rng.randint(1, n_problems),
+                "confidence": rng.randint(0, 5),
+                "ts": ts
+            })
+
+    return events
+
+def setup_db(n_problems : int = N_PROBLEMS, seed : int = 0) -> None:
+    """ Creates the database in LCTRACK_DATA_DIR, with a synthetic catalogue of n_problems problems
+    standing in for the initial sync.
+    """
+    from lctrack import access, utility
+
+    access.init_db()
+    with access.transaction() as con:
+        access.upsert_catalogue(con, *utility.parse_problem_set(make_catalogue(n_problems, seed)))
+        access.set_state(con, "initial_sync", "complete")
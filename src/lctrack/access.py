@@ -1,17 +1,281 @@
 import os
+import re
 import json
-import uuid
+import atexit
 import datetime
 import sqlite3
 import logging
-import git    
 from pathlib import Path
-from typing import Dict, Tuple, List, Any, Optional
+from contextlib import contextmanager
+from typing import Dict, Tuple, List, Any, Optional, Iterable, Iterator, Set
 
-from .sm2 import SM2
+from .sm2 import SM2, EASE_INIT, next_review_at, derive_entry_states
+from . import trace
 from .ds import Problem
 from .constants import DB_FILE, LOCAL_EVENT_HISTORY, BACKUP_EVENT_HISTORY, TMP_EVENT_HISTORY
 
+# The process-wide connection, see get_db_connection()
+_con : Optional[sqlite3.Connection] = None
+# How many transaction() blocks are currently open (nested blocks join the outermost one)
+_tx_depth = 0
+
+# (Re)builds the search index rows of the problems matching `where`
+SEARCH_INDEX_ROWS = """
+    INSERT INTO problems_fts (rowid, title, slug, topics)
+    SELECT p.id, COALESCE(p.title, ''), p.slug, COALESCE((
+        SELECT GROUP_CONCAT(t.topic_title, ' ')
+        FROM problem_topic pt
+        JOIN topics t ON t.topic_slug = pt.topic_slug
+        WHERE pt.problem_id = p.id
+    ), '')
+    FROM problems p
+    {where};
+"""
+
+# Search index columns: title, slug, topics. Title matches rank highest.
+SEARCH_WEIGHTS = (10.0, 5.0, 2.0)
+
+# A reviewed problem whose interval has reached this many days counts as mastered
+MASTERED_INTERVAL = 21
+
+STATS_TABLES = ("stats_difficulty", "stats_topic")
+STATS_COLUMNS = "problems, active, reviewed, mastered, ef_sum_milli, reviews"
+
+# The EF of a reviewed problem, in thousandths, as summed into ef_sum_milli. EF only moves in
+# steps of 0.02, so this is exact, and unlike a sum of floats, the sum doesn't drift however
+# often the triggers add and subtract it.
+def _ef_milli(p : str) -> str:
+    return f"CAST(ROUND({p}.EF * 1000) AS INTEGER)"
+
+def _stats_upsert(table : str, key : str, select : str, sign : str, p : Optional[str], reviews : str) -> str:
+    """ An upsert adding (sign = "+") or subtracting (sign = "-") the counts of problem p (a row
+    of problems, e.g. NEW, or None to only count reviews) to the rows of table selected by select,
+    which yields their key first.
+    """
+    if p is None:
+        counts = "0, 0, 0, 0, 0"
+    else:
+        reviewed = f"(COALESCE({p}.last_review_at, 0) != 0)"
+        counts = (
+            f"{sign}1, {sign}{p}.active, {sign}{reviewed}, {sign}({reviewed} AND {p}.I >= {MASTERED_INTERVAL}), "
+            f"{sign}CASE WHEN {reviewed} THEN {_ef_milli(p)} ELSE 0 END"
+        )
+
+    return f"""
+        INSERT INTO {table} ({key}, {STATS_COLUMNS})
+        SELECT {select.format(counts=f"{counts}, {sign}({reviews})")}
+        ON CONFLICT ({key}) DO UPDATE SET
+            problems = problems + excluded.problems, active = active + excluded.active,
+            reviewed = reviewed + excluded.reviewed, mastered = mastered + excluded.mastered,
+            ef_sum_milli = ef_sum_milli + excluded.ef_sum_milli, reviews = reviews + excluded.reviews;
+    """
+
+def _stats_delta(sign : str, p : Optional[str], reviews : str, problem_id : str, topic : Optional[str] = None) -> str:
+    """ Adds / subtracts the counts of problem p to its difficulty and to its topics (or just to
+    topic, if given). p is NEW / OLD within triggers on problems, else is read from problems.
+    """
+    if topic is not None:
+        return _stats_upsert(
+            "stats_topic", "topic_slug",
+            f"{topic}, {{counts}} FROM problems {p} WHERE {p}.id = {problem_id}", sign, p, reviews
+        )
+
+    # OLD.difficulty may not be the problem's current difficulty
+    difficulty = f"{p}.difficulty, {{counts}} WHERE true" if p else (
+        f"x.difficulty, {{counts}} FROM problems x WHERE x.id = {problem_id}"
+    )
+    topics = f"x.topic_slug, {{counts}} FROM problem_topic x WHERE x.problem_id = {problem_id}"
+
+    return (
+        _stats_upsert("stats_difficulty", "difficulty", difficulty, sign, p, reviews)
+        + _stats_upsert("stats_topic", "topic_slug", topics, sign, p, reviews)
+    )
+
+# The reviews of a problem move with it when its difficulty changes
+MOVED_REVIEWS = """
+    CASE WHEN OLD.difficulty IS NOT NEW.difficulty
+    THEN (SELECT COUNT(*) FROM entries WHERE problem_id = OLD.id) ELSE 0 END
+"""
+
+# Keep the stats tables current as problems, their topics and entries change. Problems are
+# never deleted, so that isn't tracked (recompute_stats would catch it up).
+STATS_TRIGGERS = {
+    "stats_problem_insert": f"""
+        AFTER INSERT ON problems BEGIN {_stats_delta("+", "NEW", "0", "NEW.id")} END
+    """,
+    "stats_problem_update": f"""
+        AFTER UPDATE OF difficulty, active, EF, I, last_review_at ON problems BEGIN
+            {_stats_delta("-", "OLD", MOVED_REVIEWS, "OLD.id")}
+            {_stats_delta("+", "NEW", MOVED_REVIEWS, "NEW.id")}
+        END
+    """,
+    "stats_problem_topic_insert": f"""
+        AFTER INSERT ON problem_topic BEGIN
+            {_stats_delta("+", "p", "(SELECT COUNT(*) FROM entries WHERE problem_id = p.id)", "NEW.problem_id", "NEW.topic_slug")}
+        END
+    """,
+    "stats_problem_topic_delete": f"""
+        AFTER DELETE ON problem_topic BEGIN
+            {_stats_delta("-", "p", "(SELECT COUNT(*) FROM entries WHERE problem_id = p.id)", "OLD.problem_id", "OLD.topic_slug")}
+        END
+    """,
+    "stats_entry_insert": f"""
+        AFTER INSERT ON entries BEGIN {_stats_delta("+", None, "1", "NEW.problem_id")} END
+    """,
+    "stats_entry_delete": f"""
+        AFTER DELETE ON entries BEGIN {_stats_delta("-", None, "1", "OLD.problem_id")} END
+    """,
+}
+
+# Rebuilds the stats tables from scratch, in one pass over problems, problem_topic and entries
+STATS_RECOMPUTE = [
+    "DELETE FROM stats_difficulty",
+    "DELETE FROM stats_topic",
+    f"""
+    CREATE TEMP TABLE stats_problem AS
+    SELECT p.id, p.difficulty,
+           1 AS problems,
+           p.active AS active,
+           COALESCE(p.last_review_at, 0) != 0 AS reviewed,
+           COALESCE(p.last_review_at, 0) != 0 AND p.I >= {MASTERED_INTERVAL} AS mastered,
+           CASE WHEN COALESCE(p.last_review_at, 0) != 0 THEN {_ef_milli("p")} ELSE 0 END AS ef_sum_milli,
+           COALESCE(e.reviews, 0) AS reviews
+    FROM problems p
+    LEFT JOIN (SELECT problem_id, COUNT(*) AS reviews FROM entries GROUP BY problem_id) e ON e.problem_id = p.id
+    """,
+    f"""
+    INSERT INTO stats_difficulty (difficulty, {STATS_COLUMNS})
+    SELECT difficulty, SUM(problems), SUM(active), SUM(reviewed), SUM(mastered), SUM(ef_sum_milli), SUM(reviews)
+    FROM temp.stats_problem
+    GROUP BY difficulty
+    """,
+    f"""
+    INSERT INTO stats_topic (topic_slug, {STATS_COLUMNS})
+    SELECT pt.topic_slug, SUM(problems), SUM(active), SUM(reviewed), SUM(mastered), SUM(ef_sum_milli), SUM(reviews)
+    FROM temp.stats_problem s
+    JOIN problem_topic pt ON pt.problem_id = s.id
+    GROUP BY pt.topic_slug
+    """,
+    "DROP TABLE temp.stats_problem",
+]
+
+# Schema upgrades, applied in order by init_db(). PRAGMA user_version records how many
+# of them a database has had applied.
+SCHEMA_UPGRADES = [
+    # 1. Base schema (IF NOT EXISTS, as it predates versioning)
+    """
+    CREATE TABLE IF NOT EXISTS problems (
+        id INTEGER PRIMARY KEY,
+        slug TEXT NOT NULL UNIQUE,
+        title TEXT,
+        difficulty INTEGER CHECK (difficulty BETWEEN 0 AND 2),
+        last_review_at INTEGER,
+        next_review_at INTEGER DEFAULT 0,
+        EF REAL DEFAULT 2.5,
+        I INTEGER DEFAULT 0,
+        n INTEGER DEFAULT 0,
+        active BOOLEAN DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS topics (
+        topic_slug TEXT PRIMARY KEY,
+        topic_title TEXT NOT NULL UNIQUE
+    );
+
+    CREATE TABLE IF NOT EXISTS problem_topic (
+        problem_id INTEGER NOT NULL,
+        topic_slug TEXT NOT NULL,
+        PRIMARY KEY (problem_id, topic_slug),
+        FOREIGN KEY (problem_id) REFERENCES problems(id) ON DELETE CASCADE,
+        FOREIGN KEY (topic_slug) REFERENCES topics(topic_slug) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS entries(
+        id TEXT PRIMARY KEY,
+        problem_id INTEGER NOT NULL,
+        confidence INTEGER NOT NULL CHECK (confidence BETWEEN 0 and 5),
+        ts INTEGER NOT NULL,
+        FOREIGN KEY (problem_id) references problems(id) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS app_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """,
+
+    # 2. Indexes for the review queue and the per-problem entry lookups
+    """
+    CREATE INDEX IF NOT EXISTS idx_problems_active_next_review ON problems (active, next_review_at);
+
+    -- Covers SELECT id, confidence, ts ... WHERE problem_id = ?, without visiting the table
+    CREATE INDEX IF NOT EXISTS idx_entries_problem_ts ON entries (problem_id, ts, confidence, id);
+    """,
+
+    # 3. The SM-2 state after each entry (NULL until the problem's entries are next replayed), so
+    # edits resume from the entry before them rather than replaying the problem's whole history.
+    # Entries are replayed in (ts, id) order, which the new index serves.
+    """
+    ALTER TABLE entries ADD COLUMN n INTEGER;
+    ALTER TABLE entries ADD COLUMN EF REAL;
+    ALTER TABLE entries ADD COLUMN I REAL;
+
+    DROP INDEX IF EXISTS idx_entries_problem_ts;
+    CREATE INDEX idx_entries_problem_ts_id ON entries (problem_id, ts, id);
+    """,
+
+    # 4. Full-text index over each problem's title, slug and topic titles (rowid = problem id),
+    # kept in step with the catalogue by upsert_catalogue. Prefix indexes make short prefix
+    # queries as cheap as whole words.
+    f"""
+    CREATE VIRTUAL TABLE problems_fts USING fts5(title, slug, topics, prefix = '2 3');
+
+    {SEARCH_INDEX_ROWS.format(where="")}
+    """,
+
+    # 5. Per difficulty / per topic summary counts for `stats` (replaced by 6)
+    """
+    CREATE TABLE stats_difficulty (difficulty INTEGER PRIMARY KEY);
+    CREATE TABLE stats_topic (topic_slug TEXT PRIMARY KEY);
+    """,
+
+    # 6. Per difficulty / per topic summary counts for `stats`, kept current by triggers (see
+    # STATS_TRIGGERS), so reading them is O(topics). ef_sum_milli is the sum of the EF of the
+    # reviewed problems, in thousandths. Replaces the tables (and triggers) of 5, whose EF sums
+    # were floats, and so drifted.
+    f"""
+    {"".join(f"DROP TRIGGER IF EXISTS {name};" for name in STATS_TRIGGERS)}
+    DROP TABLE stats_difficulty;
+    DROP TABLE stats_topic;
+
+    CREATE TABLE stats_difficulty (
+        difficulty INTEGER PRIMARY KEY,
+        problems INTEGER NOT NULL DEFAULT 0,
+        active INTEGER NOT NULL DEFAULT 0,
+        reviewed INTEGER NOT NULL DEFAULT 0,
+        mastered INTEGER NOT NULL DEFAULT 0,
+        ef_sum_milli INTEGER NOT NULL DEFAULT 0,
+        reviews INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE stats_topic (
+        topic_slug TEXT PRIMARY KEY,
+        problems INTEGER NOT NULL DEFAULT 0,
+        active INTEGER NOT NULL DEFAULT 0,
+        reviewed INTEGER NOT NULL DEFAULT 0,
+        mastered INTEGER NOT NULL DEFAULT 0,
+        ef_sum_milli INTEGER NOT NULL DEFAULT 0,
+        reviews INTEGER NOT NULL DEFAULT 0
+    );
+
+    {"".join(f"{x};" for x in STATS_RECOMPUTE)}
+    {"".join(f"CREATE TRIGGER {name} {body};" for name, body in STATS_TRIGGERS.items())}
+    """,
+]
+
+# Sorts before the (ts, id) of any entry
+FIRST_ENTRY = (-2**63, "")
+
 def get_for_review_problems() -> List[Problem]:
     now = int(datetime.datetime.now().timestamp())
 
@@ -21,19 +285,16 @@ def get_for_review_problems() -> List[Problem]:
 
         cur.execute("""
             SELECT * FROM problems
-            WHERE next_review_at <= ? 
+            WHERE next_review_at <= ?
             AND active = 1
         """, (now, ))
-        
+
         for_review = [Problem.from_row(x) for x in  cur.fetchall()]
 
         return for_review
 
     except Exception as e:
         logging.error(f"Error occured whilst attempting to fetch all 'for review' problems : {e}")
-        
-    finally:
-        con.close()
 
 def get_active() -> List[Problem]:
     con = get_db_connection()
@@ -47,46 +308,163 @@ def get_active() -> List[Problem]:
         return active
     except Exception as e:
         logging.error(f"Error occured whilst attempting to fetch all 'active' problems : {e}")
-    finally:
-        con.close()
 
 def update_SM2_state(id : int, n : int, EF : float, I : int, last_review_at : int, next_review_at : int) -> None:
-    con = get_db_connection()
+    with transaction() as con:
+        cur = con.cursor()
 
-    try:
-        with con:
-            cur = con.cursor()
-
-            cur.execute("""
-                UPDATE problems
-                SET n = ?,
-                    ef = ?,
-                    i = ?,
-                    last_review_at = ?,
-                    next_review_at = ?
-                WHERE id = ?
-            """, (n, EF, I, int(last_review_at), int(next_review_at), id))
-    finally:
-        con.close()
+        cur.execute("""
+            UPDATE problems
+            SET n = ?,
+                ef = ?,
+                i = ?,
+                last_review_at = ?,
+                next_review_at = ?
+            WHERE id = ?
+        """, (n, EF, I, int(last_review_at), int(next_review_at), id))
+
+@trace.traced("db.replace")
+def replace_entries_and_states(entries : List[Tuple[str, int, int, int]],
+                               app_state : Optional[Dict[str, str]] = None) -> List[Tuple[int, float, float, int, int, int]]:
+    """ Replaces the contents of the entries table, replaying the entries of each problem to
+    derive the SM-2 state after every entry and of every problem, within a single transaction.
+    Nothing is appended to the event history.
+
+    entries : [(id, problem_id, confidence, ts)]
+    app_state : key -> value pairs written to app_state within the same transaction
+
+    Returns the new states [(n, EF, I, last_review_at, next_review_at, problem_id)] of the problems
+    with entries.
+    """
+    rows, new_states = derive_entry_states(entries)
 
-def bulk_update_SM2_state(new_states : List[int, float, int, int, int, int]) -> None:
-    con = get_db_connection()
+    with transaction() as con, stats_paused(con):
+        cur = con.cursor()
 
-    try:
-        with con:
-            cur = con.cursor()
-            cur.executemany("""
-                UPDATE problems 
-                SET n = ?, EF = ?, I = ?, last_review_at = ?, next_review_at = ?
-                WHERE id = ?
-            """, new_states)
-    finally:
-        con.close()
+        cur.execute("DELETE FROM entries")
+        cur.executemany("""
+            INSERT INTO entries (id, problem_id, confidence, ts, n, EF, I)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+        # Problems left without any entries fall back to the default state
+        cur.execute("""
+            UPDATE problems
+            SET n = 0, EF = 2.5, I = 0, last_review_at = 0, next_review_at = 0
+            WHERE n != 0 OR last_review_at != 0
+        """)
+        cur.executemany("""
+            UPDATE problems
+            SET n = ?, EF = ?, I = ?, last_review_at = ?, next_review_at = ?
+            WHERE id = ?
+        """, new_states)
+
+        for key, value in (app_state or {}).items():
+            set_state(con, key, value)
+
+    return new_states
+
+def restate_entries(con : sqlite3.Connection, problem_id : int, start : Tuple[int, str] = FIRST_ENTRY) -> None:
+    """ Brings the cached SM-2 states of a problem's entries, and the problem's own state, up to
+    date after its entries from position start = (ts, id) onwards changed. Replay resumes from the
+    cached state of the entry before start, so only the entries from start onwards are read and
+    rewritten.
+    """
+    cur = con.cursor()
+
+    prev = cur.execute("""
+        SELECT n, EF, I, ts FROM entries
+        WHERE problem_id = ? AND (ts, id) < (?, ?)
+        ORDER BY ts DESC, id DESC
+        LIMIT 1
+    """, (problem_id, *start)).fetchone()
+
+    if prev is None:
+        n, EF, I, last_review_at = 0, EASE_INIT, 0, None
+    elif prev[0] is None: # Cached before the state was, so replay from the first entry
+        return restate_entries(con, problem_id)
+    else:
+        n, EF, I, last_review_at = prev
+
+    cur.execute("""
+        SELECT id, confidence, ts FROM entries
+        WHERE problem_id = ? AND (ts, id) >= (?, ?)
+        ORDER BY ts, id
+    """, (problem_id, *start))
+
+    entry_states = []
+    for entry_uuid, q, last_review_at in cur.fetchall():
+        n, EF, I = SM2(q, n, EF, I)
+        entry_states.append((n, EF, I, entry_uuid))
+
+    cur.executemany("UPDATE entries SET n = ?, EF = ?, I = ? WHERE id = ?", entry_states)
+
+    if last_review_at is None: # No entries left, so fall back to the default state
+        state = (0, EASE_INIT, 0, 0, 0, problem_id)
+    else:
+        state = (n, EF, I, last_review_at, next_review_at(last_review_at, I), problem_id)
+
+    cur.execute("""
+        UPDATE problems
+        SET n = ?, EF = ?, I = ?, last_review_at = ?, next_review_at = ?
+        WHERE id = ?
+    """, state)
+
+@trace.traced("db.apply")
+def apply_entry_changes(new_entries : List[Tuple[str, int, int, int]],
+                        removed_entry_uuids : List[str],
+                        app_state : Optional[Dict[str, str]] = None) -> List[int]:
+    """ Inserts / removes the given entries, then brings the SM-2 state of only the problems
+    they belong to up to date, resuming each from its earliest changed entry (see
+    restate_entries), within a single transaction. Nothing is appended to the event history.
+    Entries that are already present, or already removed, are skipped.
+
+    new_entries : [(id, problem_id, confidence, ts)]
+    app_state : key -> value pairs written to app_state within the same transaction
+
+    Returns the ids of the problems whose state was recalculated.
+    """
+    with transaction() as con:
+        cur = con.cursor()
+
+        cur.executemany("""
+            INSERT OR IGNORE INTO entries (id, problem_id, confidence, ts)
+            VALUES (?, ?, ?, ?)
+        """, new_entries)
+
+        # json_each avoids SQLite's limit on the number of bound parameters
+        removed = json.dumps(removed_entry_uuids)
+        cur.execute("""
+            SELECT id, problem_id, confidence, ts FROM entries
+            WHERE id IN (SELECT value FROM json_each(?))
+        """, (removed,))
+        changed = cur.fetchall() + list(new_entries)
+
+        cur.execute("DELETE FROM entries WHERE id IN (SELECT value FROM json_each(?))", (removed,))
+
+        # problem_id -> (ts, id) of its earliest changed entry
+        starts : Dict[int, Tuple[int, str]] = {}
+        for entry_uuid, problem_id, _, ts in changed:
+            starts[problem_id] = min(starts.get(problem_id, (ts, entry_uuid)), (ts, entry_uuid))
+
+        for problem_id, start in starts.items():
+            restate_entries(con, problem_id, start)
+
+        for key, value in (app_state or {}).items():
+            set_state(con, key, value)
+
+        return sorted(starts)
 
 def append_event(event: Dict[str, Any]) -> None:
-    with open(LOCAL_EVENT_HISTORY, "a", encoding="utf-8") as f:
-        json_event = json.dumps(event)
-        f.write(json_event + '\n')
+    from .backup import append_events # backup imports access
+
+    append_events(LOCAL_EVENT_HISTORY, [event])
+
+def append_events(events: List[Dict[str, Any]]) -> None:
+    """ Appends the events to the local event history, in a single write. """
+    from .backup import append_events # backup imports access
+
+    append_events(LOCAL_EVENT_HISTORY, events)
 
 def create_add_entry_event(entry_uuid : str, problem_id: int, confidence: int, ts: int) -> Dict[str, Any]:
     """Returns a dictionary representing an ADD_ENTRY event with a unique ID."""
@@ -99,6 +477,8 @@ def create_add_entry_event(entry_uuid : str, problem_id: int, confidence: int, t
     }
 
 def create_rm_entry_event(entry_uuid : int, ts : int) -> Dict[str, Any]:
+    import uuid
+
     return {
         "id" : str(uuid.uuid4()), # Uniquely identify the event
         "event" : "RM_ENTRY",
@@ -107,171 +487,122 @@ def create_rm_entry_event(entry_uuid : int, ts : int) -> Dict[str, Any]:
     }
 
 def insert_entry(entry_uuid : str, problem_id: int, confidence: int, ts: int) -> int:
+    with transaction() as con:
+        cur = con.cursor()
 
-    con = get_db_connection()
+        cur.execute(
+            """
+            INSERT INTO entries (id, problem_id, confidence, ts)
+            VALUES (?, ?, ?, ?)
+            """,
+            (entry_uuid, problem_id, confidence, ts)
+        )
+        restate_entries(con, problem_id, (ts, entry_uuid))
 
-    try:
-        with con:
-            cur = con.cursor()
-
-            cur.execute(
-                """
-                INSERT INTO entries (id, problem_id, confidence, ts) 
-                VALUES (?, ?, ?, ?)
-                """,
-                (entry_uuid, problem_id, confidence, ts)
-            )
-
-            # If the above succeeds, append a ADD_ENTRY
-            append_event(
-                create_add_entry_event(entry_uuid, problem_id, confidence, ts)
-            )
-            
-            return entry_uuid
-    finally:
-        con.close()
+        # If the above succeeds, append a ADD_ENTRY
+        append_event(
+            create_add_entry_event(entry_uuid, problem_id, confidence, ts)
+        )
 
-def rm_entry(entry_uuid : str) -> int:
-    """ Removes a specific entry from the local database, then recalculates
-    the SM2 state for the corresponding problem using the remaining entries.
-    
-    Returns the problem_id of the problem corresponding to the specified event.
+        return entry_uuid
+
+@trace.traced("db.insert_entries")
+def insert_entries(entries : List[Tuple[str, int, int, int]]) -> List[int]:
+    """ Bulk version of insert_entry: inserts the entries (id, problem_id, confidence, ts),
+    recalculates the SM-2 state of each problem they belong to once (from all of its entries,
+    so back dated entries are replayed in order), and appends their ADD_ENTRY events with a
+    single write, all within one transaction.
+
+    Returns the ids of the problems whose state was recalculated.
     """
-    rec = get_entry(entry_uuid)
-    if rec is None:
-        raise RuntimeError(f"No entry exists with uuid: {entry_uuid}")
+    with transaction():
+        touched = apply_entry_changes(entries, [])
+        append_events([create_add_entry_event(*x) for x in entries])
 
-    _, problem_id, *_ = rec
-    con = get_db_connection()
-    try:
-        with con:
-            # Delete the entry
-            cur = con.cursor()
-            cur.execute("DELETE FROM entries WHERE id = ?", (entry_uuid,))
-
-            # Get all of the entries for the problem_id
-            cur.execute("SELECT id, confidence, ts FROM entries WHERE problem_id = ?", (problem_id,))
-            entries = cur.fetchall()
-
-            n, EF, I = 0, 2.5, 0.0
-            if not entries:     
-                last_review_at = 0
-                next_review_at = 0
-            else:
-                entries.sort(key=lambda x: x[2])  # ts asc
-                last_ts = 0
-                for _, conf, ts in entries:
-                    n, EF, I = SM2(conf, n, EF, I)
-                    last_ts = ts
-                last_review_at = last_ts
-                next_review_at = last_ts + int(round(I * 86400))
-            
-            cur.execute("""
-                UPDATE problems
-                SET n = ?,
-                    ef = ?,
-                    i = ?,
-                    last_review_at = ?,
-                    next_review_at = ?
-                WHERE id = ?
-            """, (n, EF, I, int(last_review_at), int(next_review_at), problem_id))
-
-            # If the above succeeds, append a RM_ENTRY event
-            now_unix_ts = int(datetime.datetime.now().timestamp())
-
-            append_event(
-                create_rm_entry_event(entry_uuid, now_unix_ts)
-            )
-
-            return problem_id
-    finally:
-        con.close()
+    return touched
 
-def get_entry(entry_uuid : str) -> Optional[Tuple[int, int, int, int]]:
-    con = get_db_connection()
-    
-    try:
-        with con:
-            cur = con.cursor()
+@trace.traced("db.rm_entry")
+def rm_entry(entry_uuid : str) -> int:
+    """ Removes a specific entry from the local database, then brings the SM2 state of the
+    corresponding problem up to date, replaying only the entries after the removed one.
 
-            cur.execute("""
-                SELECT id, problem_id, confidence, ts  
-                FROM entries
-                WHERE id = ?
-            """, (entry_uuid,))
+    Returns the problem_id of the problem corresponding to the specified event.
+    """
+    with transaction() as con:
+        rec = get_entry(entry_uuid)
+        if rec is None:
+            raise RuntimeError(f"No entry exists with uuid: {entry_uuid}")
 
-            row : Optional[Tuple[int, int, int, int]] = cur.fetchone()
+        _, problem_id, _, ts = rec
 
-        return row
+        # Delete the entry
+        cur = con.cursor()
+        cur.execute("DELETE FROM entries WHERE id = ?", (entry_uuid,))
 
-    finally:
-        con.close()
+        restate_entries(con, problem_id, (ts, entry_uuid))
 
-def process_event(event) -> None:
-    if event['event'] == "ADD_ENTRY":
-        event_uuid, problem_id, confidence, ts = (
-            event['id'], event['problem_id'], event['confidence'], event['ts']
+        # If the above succeeds, append a RM_ENTRY event
+        now_unix_ts = int(datetime.datetime.now().timestamp())
+
+        append_event(
+            create_rm_entry_event(entry_uuid, now_unix_ts)
         )
-        insert_entry(event_uuid, problem_id, confidence, ts)
-         
-    elif event['event'] == "RM_ENTRY":
-        target_entry_uuid  = event['target_entry_uuid']
-        rm_entry(target_entry_uuid)
-    else:
-        raise Exception(f"Unexpected 'event' of type {event['event']}")
 
-def clear_entries_table() -> None:
+        return problem_id
+
+def get_entry(entry_uuid : str) -> Optional[Tuple[int, int, int, int]]:
     con = get_db_connection()
+    cur = con.cursor()
 
-    try:
-        with con:
-            cur = con.cursor()
+    cur.execute("""
+        SELECT id, problem_id, confidence, ts
+        FROM entries
+        WHERE id = ?
+    """, (entry_uuid,))
 
-            cur.execute("DELETE FROM entries")
-    except:
-        con.close()
+    row : Optional[Tuple[int, int, int, int]] = cur.fetchone()
+
+    return row
 
 def get_all_entries_by_problem_id(problem_id : int) -> List[Tuple[str, int, int, int]]:
     con = get_db_connection()
-    
-    try:
-        cur = con.cursor()
-        
-        cur.execute("""
-            SELECT id, problem_id, confidence, ts  
-            FROM entries
-            WHERE problem_id = ?
-        """, (problem_id,))
+    cur = con.cursor()
 
-        return cur.fetchall()
+    cur.execute("""
+        SELECT id, problem_id, confidence, ts
+        FROM entries
+        WHERE problem_id = ?
+    """, (problem_id,))
 
-    finally:
-        con.close()
+    return cur.fetchall()
 
 def get_all_entries() -> List[Tuple[str, int, int, int]]:
     con = get_db_connection()
-    try:
-        cur = con.cursor()
-        cur.execute("SELECT id, problem_id, confidence, ts FROM entries")
+    cur = con.cursor()
+    cur.execute("SELECT id, problem_id, confidence, ts FROM entries")
 
-        return cur.fetchall()
-    finally:
-        con.close()
+    return cur.fetchall()
+
+def get_existing_problem_ids(ids : Iterable[int]) -> Set[int]:
+    """ The subset of ids that are in the problems table, in one query. """
+    con = get_db_connection()
+    cur = con.execute(
+        "SELECT id FROM problems WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(sorted(set(ids))),)
+    )
+
+    return {x[0] for x in cur.fetchall()}
 
 def get_problem(id: int) -> Optional[Problem]:
     con = get_db_connection()
-    try:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM problems WHERE id = ?", (id,))
-        row = cur.fetchone()
-        
-        if row is None:
-            return None
-            
-        return Problem.from_row(row)
-        
-    finally:
-        con.close()
+    cur = con.cursor()
+    cur.execute("SELECT * FROM problems WHERE id = ?", (id,))
+    row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    return Problem.from_row(row)
 
 def get_problem_topics(problem_id : int) -> List[str]:
     con = get_db_connection()
@@ -287,92 +618,199 @@ def get_problem_topics(problem_id : int) -> List[str]:
         return [x[0] for  x in cur.fetchall()]
     except Exception as e:
         logging.error(f"Error fetching topics for problem {problem_id}: {e}")
-    finally:
-        con.close()
-    
-def set_active(id: int, active: bool) -> None:  
+
+def set_active(id: int, active: bool) -> None:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            "UPDATE problems SET active = ? WHERE id = ?",
+            (active, id)
+        )
+
+def set_active_where(active : bool,
+                     ids : Optional[Iterable[int]] = None,
+                     topics : Optional[List[str]] = None,
+                     difficulty : Optional[int] = None) -> Tuple[int, int]:
+    """ Sets the active flag of every problem matching all of the given filters (any of the
+    ids, any of the topic slugs, the difficulty), in a single UPDATE.
+
+    Returns the number of problems matched, and the number whose flag actually changed.
+    """
+    conditions, params = [], []
+    if ids is not None:
+        conditions.append("id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(sorted(set(ids))))
+    if topics:
+        conditions.append("""id IN (
+            SELECT problem_id FROM problem_topic
+            WHERE topic_slug IN (SELECT value FROM json_each(?))
+        )""")
+        params.append(json.dumps(topics))
+    if difficulty is not None:
+        conditions.append("difficulty = ?")
+        params.append(difficulty)
+
+    if not conditions:
+        raise ValueError("set_active_where needs at least one filter")
+
+    where = " AND ".join(conditions)
+    with transaction() as con:
+        cur = con.cursor()
+        matched = cur.execute(f"SELECT COUNT(*) FROM problems WHERE {where}", params).fetchone()[0]
+        cur.execute(f"UPDATE problems SET active = ? WHERE active != ? AND {where}", [active, active, *params])
+
+        return matched, cur.rowcount
+
+def recompute_stats(con : sqlite3.Connection) -> None:
+    """ Rebuilds the stats tables from problems, problem_topic and entries. """
+    for stmt in STATS_RECOMPUTE:
+        con.execute(stmt)
+
+@contextmanager
+def stats_paused(con : sqlite3.Connection) -> Iterator[None]:
+    """ Drops the stats triggers for the enclosed block (within the caller's transaction), then
+    recomputes the stats tables in one pass and recreates the triggers. For bulk changes, where
+    per-row trigger updates would cost more than a recompute.
+    """
+    for name in STATS_TRIGGERS:
+        con.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    yield
+
+    recompute_stats(con)
+    for name, body in STATS_TRIGGERS.items():
+        con.execute(f"CREATE TRIGGER {name} {body}")
+
+def get_stats(now : Optional[int] = None) -> Tuple[List[Tuple], List[Tuple]]:
+    """ The summary counts by difficulty and by topic:
+    ([(difficulty, problems, active, due, reviewed, mastered, mean_EF, reviews)],
+     [(topic_title, problems, active, due, reviewed, mastered, mean_EF, reviews)])
+
+    Due counts depend on the time, so are counted from the active problems that are due (via
+    the review queue index) rather than kept in the stats tables. mean_EF is over reviewed
+    problems, or None if there are none.
+    """
+    now = int(datetime.datetime.now().timestamp()) if now is None else now
     con = get_db_connection()
-    try:
-        with con:
-            cur = con.cursor()
-            cur.execute(
-                "UPDATE problems SET active = ? WHERE id = ?", 
-                (active, id)
-            )
-    finally:
-        con.close()
+
+    by_difficulty = con.execute("""
+        WITH due AS (
+            SELECT difficulty, COUNT(*) AS due FROM problems
+            WHERE active = 1 AND next_review_at <= ?
+            GROUP BY difficulty
+        )
+        SELECT s.difficulty, s.problems, s.active, COALESCE(d.due, 0), s.reviewed, s.mastered,
+               s.ef_sum_milli / 1000.0 / NULLIF(s.reviewed, 0), s.reviews
+        FROM stats_difficulty s
+        LEFT JOIN due d ON d.difficulty = s.difficulty
+        ORDER BY s.difficulty
+    """, (now,)).fetchall()
+
+    by_topic = con.execute("""
+        WITH due AS (
+            SELECT pt.topic_slug, COUNT(*) AS due FROM problems p
+            JOIN problem_topic pt ON pt.problem_id = p.id
+            WHERE p.active = 1 AND p.next_review_at <= ?
+            GROUP BY pt.topic_slug
+        )
+        SELECT t.topic_title, s.problems, s.active, COALESCE(d.due, 0), s.reviewed, s.mastered,
+               s.ef_sum_milli / 1000.0 / NULLIF(s.reviewed, 0), s.reviews
+        FROM stats_topic s
+        JOIN topics t ON t.topic_slug = s.topic_slug
+        LEFT JOIN due d ON d.topic_slug = s.topic_slug
+        ORDER BY s.active DESC, s.reviews DESC, t.topic_title
+    """, (now,)).fetchall()
+
+    return by_difficulty, by_topic
 
 def get_db_connection() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_FILE)
-    con.execute("PRAGMA foreign_keys = ON;")
-    con.isolation_level = ""
-    return con
+    """ Returns the process-wide connection to the database, opening it on first use.
 
-def db_exists() -> bool:
-    return os.path.exists(DB_FILE)
+    The connection is in autocommit mode: statements outside of a transaction() block
+    are committed as they run. Prepared statements are cached on the connection, so
+    reusing it across calls also reuses their compiled SQL.
+    """
+    global _con
+
+    if _con is None:
+        _con = sqlite3.connect(DB_FILE, isolation_level=None, cached_statements=256)
+        _con.execute("PRAGMA foreign_keys = ON;")
+        _con.execute("PRAGMA journal_mode = WAL;")
+        _con.execute("PRAGMA synchronous = NORMAL;")
+        if trace.enabled:
+            _con.set_trace_callback(trace.count_statement)
+        atexit.register(close_db_connection)
+
+    return _con
+
+def close_db_connection() -> None:
+    global _con
+
+    if _con is not None:
+        # Lets SQLite refresh the query planner statistics, if they have gone stale
+        _con.execute("PRAGMA optimize;")
+        _con.close()
+        _con = None
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """ Runs the enclosed block in a single transaction on the process-wide connection,
+    committing on success and rolling back if an exception is raised.
+
+    Blocks can be nested (e.g. calling several access functions within one block), in
+    which case the inner blocks join the outermost transaction.
+    """
+    global _tx_depth
 
-def init_db() -> None:
-    con = get_db_connection()    
-    cur = con.cursor()
+    con = get_db_connection()
 
-    # 2. Define the schema
-    stmt = """
-    CREATE TABLE IF NOT EXISTS problems (
-        id INTEGER PRIMARY KEY,
-        slug TEXT NOT NULL UNIQUE, 
-        title TEXT,
-        difficulty INTEGER CHECK (difficulty BETWEEN 0 AND 2),
-        last_review_at INTEGER,
-        next_review_at INTEGER DEFAULT 0,
-        EF REAL DEFAULT 2.5,
-        I INTEGER DEFAULT 0,
-        n INTEGER DEFAULT 0,
-        active BOOLEAN DEFAULT 0
-    );
+    if _tx_depth:
+        _tx_depth += 1
+        try:
+            yield con
+        finally:
+            _tx_depth -= 1
+        return
 
-    CREATE TABLE IF NOT EXISTS topics (
-        topic_slug TEXT PRIMARY KEY,
-        topic_title TEXT NOT NULL UNIQUE
-    );
+    con.execute("BEGIN")
+    _tx_depth = 1
+    try:
+        yield con
+    except BaseException:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+    finally:
+        _tx_depth = 0
 
-    CREATE TABLE IF NOT EXISTS problem_topic (
-        problem_id INTEGER NOT NULL,
-        topic_slug TEXT NOT NULL,
-        PRIMARY KEY (problem_id, topic_slug),
-        FOREIGN KEY (problem_id) REFERENCES problems(id) ON DELETE CASCADE,
-        FOREIGN KEY (topic_slug) REFERENCES topics(topic_slug) ON DELETE CASCADE
-    );
+def db_exists() -> bool:
+    return os.path.exists(DB_FILE)
 
-    CREATE TABLE IF NOT EXISTS entries(
-        id TEXT PRIMARY KEY, 
-        problem_id INTEGER NOT NULL,
-        confidence INTEGER NOT NULL CHECK (confidence BETWEEN 0 and 5),
-        ts INTEGER NOT NULL,
-        FOREIGN KEY (problem_id) references problems(id) ON DELETE CASCADE
-    );
+@trace.traced("db.init")
+def init_db() -> None:
+    """ Creates the schema, or upgrades an existing database to the latest version of it.
 
-    CREATE TABLE IF NOT EXISTS app_state (
-        key TEXT PRIMARY KEY, 
-        value TEXT
-    );
+    Each entry of SCHEMA_UPGRADES is applied, in its own transaction, if the database's
+    PRAGMA user_version shows it hasn't been already.
     """
+    con = get_db_connection()
+    current = con.execute("PRAGMA user_version").fetchone()[0]
 
-    cur.executescript(stmt)
-    con.commit()
+    for version, stmt in enumerate(SCHEMA_UPGRADES[current:], current + 1):
+        try:
+            con.executescript(f"BEGIN; {stmt} PRAGMA user_version = {version}; COMMIT;")
+        except Exception:
+            if con.in_transaction:
+                con.rollback()
+            raise
 
 def get_state(key : str) -> Optional[str]:
     con = get_db_connection()
-    try:
-        cur = con.execute("SELECT value FROM app_state WHERE key = ?", (key, ))
-        row = cur.fetchone()
-    
-        return row[0] if row else None
+    cur = con.execute("SELECT value FROM app_state WHERE key = ?", (key, ))
+    row = cur.fetchone()
 
-    finally:
-        con.close()
-
-def set_state(con, key: str, value: str) -> None:
-    con.execute("REPLACE INTO app_state (key, value) VALUES (?, ?)", (key, value))
+    return row[0] if row else None
 
 def insert_problems(con : sqlite3.Connection, problems : List[Tuple[int, str]]):
     """ Batch inserts the lc problems (id, slug) into the problems table.
@@ -384,10 +822,131 @@ def insert_problems(con : sqlite3.Connection, problems : List[Tuple[int, str]]):
     """
     cur.executemany(stmt, problems)
 
+def get_startup_state() -> Tuple[int, Optional[str]]:
+    """ Returns the schema version and the 'initial_sync' state, in a single query, for
+    the checks run before every command.
+    """
+    con = get_db_connection()
+    try:
+        return con.execute("""
+            SELECT (SELECT user_version FROM pragma_user_version),
+                   (SELECT value FROM app_state WHERE key = 'initial_sync')
+        """).fetchone()
+    except sqlite3.OperationalError: # The app_state table doesn't exist yet
+        return 0, None
+
+def get_catalogue() -> List[Tuple[int, str, str, int, str]]:
+    """ Returns every problem as (id, slug, title, difficulty, topics), ordered by id, where topics
+    is a ';' separated list of topic_slug:topic_title pairs.
+    """
+    con = get_db_connection()
+    return con.execute("""
+        SELECT p.id, p.slug, p.title, p.difficulty,
+               COALESCE(GROUP_CONCAT(t.topic_slug || ':' || t.topic_title, ';'), '')
+        FROM problems p
+        LEFT JOIN problem_topic pt ON pt.problem_id = p.id
+        LEFT JOIN topics t ON t.topic_slug = pt.topic_slug
+        GROUP BY p.id
+        ORDER BY p.id
+    """).fetchall()
+
+def get_catalogue_extent() -> Tuple[int, int]:
+    """ Returns the number of problems in the catalogue, and the highest problem id. """
+    con = get_db_connection()
+    return con.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM problems").fetchone()
+
+@trace.traced("db.upsert_catalogue")
+def upsert_catalogue(con : sqlite3.Connection,
+                     problems : List[Tuple[int, str, str, int]],
+                     topics : List[Tuple[str, str]],
+                     problem_topics : List[Tuple[int, str]]) -> int:
+    """ Inserts new problems (id, slug, title, difficulty) and topics (slug, title), and updates
+    those that have changed, leaving the SM-2 state and active flag of existing problems alone.
+    The topics of each given problem are replaced by those in problem_topics.
+
+    Returns the number of problems inserted or changed.
+    """
+    cur = con.cursor()
+
+    cur.executemany("""
+        INSERT INTO problems (id, slug, title, difficulty) VALUES (?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE
+        SET slug = excluded.slug, title = excluded.title, difficulty = excluded.difficulty
+        WHERE (slug, title, difficulty) IS NOT (excluded.slug, excluded.title, excluded.difficulty)
+    """, problems)
+    # rowcount (unlike con.total_changes) leaves out the rows written by triggers, e.g. the stats tables
+    changed = cur.rowcount
+
+    cur.executemany("""
+        INSERT INTO topics (topic_slug, topic_title) VALUES (?, ?)
+        ON CONFLICT (topic_slug) DO UPDATE
+        SET topic_title = excluded.topic_title
+        WHERE topic_title IS NOT excluded.topic_title
+    """, topics)
+
+    cur.execute(
+        "DELETE FROM problem_topic WHERE problem_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([x[0] for x in problems]),)
+    )
+    cur.executemany("INSERT OR IGNORE INTO problem_topic (problem_id, topic_slug) VALUES (?, ?)", problem_topics)
+
+    cur.execute(
+        "DELETE FROM problems_fts WHERE rowid IN (SELECT value FROM json_each(?))",
+        (json.dumps([x[0] for x in problems]),)
+    )
+    cur.execute(
+        SEARCH_INDEX_ROWS.format(where="WHERE p.id IN (SELECT value FROM json_each(?))"),
+        (json.dumps([x[0] for x in problems]),)
+    )
+
+    return changed
+
+def to_fts_query(text : str) -> str:
+    """ Converts free text into an FTS5 query matching problems containing every word of it as
+    a prefix, e.g. "bin tree" -> '"bin"* "tree"*'.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        raise ValueError("expected at least one word to search for")
+
+    return " ".join(f'"{x}"*' for x in words)
+
+def search_problems(text : str,
+                    difficulty : Optional[int] = None,
+                    active : Optional[bool] = None,
+                    due : bool = False,
+                    limit : int = 20) -> List[Problem]:
+    """ The problems whose title, slug or topics match every word of text (as prefixes), best
+    match first, optionally only those of a difficulty, active or not, and due for review.
+    """
+    conditions, params = ["problems_fts MATCH :query"], {"query": to_fts_query(text), "limit": limit}
+    if difficulty is not None:
+        conditions.append("p.difficulty = :difficulty")
+        params["difficulty"] = difficulty
+    if active is not None:
+        conditions.append("p.active = :active")
+        params["active"] = active
+    if due:
+        conditions.append("p.active = 1 AND p.next_review_at <= :now")
+        params["now"] = int(datetime.datetime.now().timestamp())
+
+    con = get_db_connection()
+    cur = con.execute(f"""
+        SELECT p.* FROM problems_fts
+        JOIN problems p ON p.id = problems_fts.rowid
+        WHERE {" AND ".join(conditions)}
+        ORDER BY bm25(problems_fts, {", ".join(str(x) for x in SEARCH_WEIGHTS)})
+        LIMIT :limit
+    """, params)
+
+    return [Problem.from_row(x) for x in cur.fetchall()]
+
 def set_state(con, key: str, value: str) -> None:
     con.execute("REPLACE INTO app_state (key, value) VALUES (?, ?)", (key, value))
 
 def check_repo(path : Path) -> bool:
+    import git
+
     try:
         git.Repo(path)
         # If this succeeds, this is a valid repo
@@ -398,7 +957,3 @@ def check_repo(path : Path) -> bool:
     except git.NoSuchPathError as exc:
         # The folder doesn't even exist
         return False
-
-
-
-
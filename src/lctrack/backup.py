@@ -1,103 +1,926 @@
 
 import json
+import mmap
+import bisect
+import datetime
+import heapq
+import shutil
+import struct
+import hashlib
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Set, Tuple, Iterable, Iterator, Optional
 
-from .constants import TMP_EVENT_HISTORY, BACKUP_EVENT_HISTORY, LOCAL_EVENT_HISTORY
-from .sm2 import SM2
+from .constants import (TMP_EVENT_HISTORY, BACKUP_EVENT_HISTORY, BACKUP_SEGMENTS_DIR,
+                        LOCAL_EVENT_HISTORY, STATE_SNAPSHOT_DIR)
 from . import access
+from . import trace
 
-def merge_event_histories(hist1 : Path, hist2 : Path) -> List[Dict[str, Any]]:
-    # Load both event histories into memory
-    events_local : List[dict] = load_event_history(hist1)
-    events_backup : List[dict] = load_event_history(hist2)
+# app_state key under which the replay high-water mark is stored, as
+# "<byte offset>:<event count>:<sha256 of the log up to the byte offset>"
+REPLAY_CHECKPOINT = "REPLAY_CHECKPOINT"
 
-    # Merge the two into a single list of unique events, sorted by ts
-    combined_events = list({event['id']: event for event in events_backup + events_local}.values())
-    combined_events.sort(key=lambda x : x['ts'])
+# Event history formats. JSONL (one JSON object per line) is the default; BINARY is a
+# header followed by one fixed-width record per event, see BINARY_RECORD.
+JSONL = "jsonl"
+BINARY = "binary"
 
-    return combined_events
+BINARY_MAGIC = b"LCEVLOG\x01"
+# id (16 byte UUID), event type (1 byte), problem_id (int32), confidence (int8), ts (int64),
+# target_entry_uuid (16 byte UUID, zeroed unless RM_ENTRY); little-endian, no padding
+BINARY_RECORD = struct.Struct("<16sBibq16s")
+BINARY_CHUNK = BINARY_RECORD.size * 4096
 
-def load_event_history(path : Path) -> List[Dict[str, Any]]:
+EVENT_TYPE_CODES = {"ADD_ENTRY": 1, "RM_ENTRY": 2}
+NULL_UUID = bytes(16)
+
+# Sidecar index of an event history ("<history>.idx"): a header, then one record per event:
+# key (16 byte hash of the event id), byte offset, byte length, ts. The header holds the number
+# of records sorted by key (as of the last build) and the length of the history they cover; the
+# records of events appended since follow them, unsorted, in log order.
+EVENT_INDEX_MAGIC = b"LCEVIDX\x02"
+EVENT_INDEX_HEADER = struct.Struct("<QQ")
+EVENT_INDEX_RECORD = struct.Struct("<16sQIq")
+EVENT_INDEX_START = len(EVENT_INDEX_MAGIC) + EVENT_INDEX_HEADER.size
+
+# Once this many records have been appended to the unsorted tail of an index, the next lookup
+# sorts them into the rest, keeping lookups to a binary search plus a short scan
+EVENT_INDEX_TAIL_MAX = 4096
+
+# app_state key under which the checkpoint of LOCAL_EVENT_HISTORY, as of the end of the last
+# sync, is stored. Every event up to it is in the backup, so only those after it need uploading.
+BACKUP_CHECKPOINT = "BACKUP_CHECKPOINT"
+# app_state key under which the remote's head commit, as of the end of the last sync, is stored
+SYNC_REMOTE_HEAD = "SYNC_REMOTE_HEAD"
+# app_state key of this device's id, which names its directory of backup segments
+DEVICE_ID = "DEVICE_ID"
+MANIFEST = "manifest.json"
+
+# A state snapshot is taken once this many events have been replayed since the latest one,
+# and only the newest SNAPSHOT_KEEP are kept
+SNAPSHOT_INTERVAL = 10_000
+SNAPSHOT_KEEP = 3
+
+def event_key(event : Dict[str, Any]) -> Tuple[int, str]:
+    """ The order in which events are stored and replayed: by ts, ties broken by id. """
+    return event['ts'], event['id']
+
+@trace.traced("merge")
+def merge_event_histories(*paths : Path,
+                          dest : Path = TMP_EVENT_HISTORY,
+                          fmt : str = JSONL,
+                          drop_cancelled : bool = False) -> int:
+    """ Merges any number of event histories into a single history of unique events,
+    sorted by (ts, id), which is written to dest in the given format.
+
+    Each input is streamed and combined with a k-way merge, deduplicating by id as it
+    goes, so memory use does not grow with the length of the histories. Should an input
+    turn out not to be sorted (e.g. a local log with back dated appends), the merge is
+    restarted with the input split at its first out of order event: its sorted prefix is
+    still streamed, and only the rest of it is sorted in memory.
+
+    With drop_cancelled, the merged history is also compacted (see compact_event_history).
+
+    Returns the number of events written.
+    """
+    cancelled = set()
+    if drop_cancelled:
+        for path in paths:
+            cancelled.update(cancelled_entry_uuids(path))
+
+    # Input -> byte offset of its first out of order event, once found
+    unsorted_from : Dict[Path, int] = {}
+
+    def streams():
+        for path in paths:
+            if path in unsorted_from:
+                split = unsorted_from[path]
+                yield (event for _, event in _iter_event_records(path, 0, split))
+                yield iter(sorted((event for _, event in _iter_event_records(path, split)), key=event_key))
+            else:
+                yield _iter_sorted_event_records(path)
+
+    def unique_events():
+        last_key = None
+        for event in heapq.merge(*streams(), key=event_key):
+            key = event_key(event)
+            if key == last_key: # The same event, present in more than one history
+                continue
+            if event['event'] == "ADD_ENTRY" and event['id'] in cancelled:
+                continue
+
+            yield event
+            last_key = key
+
+    while True:
+        try:
+            return write_event_history(dest, unique_events(), fmt)
+        except _UnsortedEventHistory as exc:
+            unsorted_from[exc.path] = exc.offset
+
+class _UnsortedEventHistory(Exception):
+    def __init__(self, path : Path, offset : int):
+        super().__init__(f"{path} is out of order from byte {offset}")
+        self.path = path
+        self.offset = offset
+
+def _iter_sorted_event_records(path : Path) -> Iterator[Dict[str, Any]]:
+    """ Streams the events of an event history, raising _UnsortedEventHistory at the first one
+    that is out of order.
+    """
+    last_key = None
+    for offset, event in _iter_event_records(path):
+        key = event_key(event)
+        if last_key is not None and key < last_key:
+            raise _UnsortedEventHistory(path, offset)
+        last_key = key
+
+        yield event
+
+def _iter_event_records(path : Path, start : int = 0, end : Optional[int] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """ Streams (byte offset, event) for the events of an event history, in either format,
+    stored between the byte offsets start and end (to the end of the file if None).
+    """
     if not path.exists():
-        return []
-    
-    events = []
+        return
+
+    with open(path, "rb") as f:
+        if detect_event_history_format(path) == BINARY:
+            offset = f.seek(max(start, len(BINARY_MAGIC)))
+            while end is None or offset < end:
+                chunk = f.read(BINARY_CHUNK if end is None else min(BINARY_CHUNK, end - offset))
+                if not chunk:
+                    break
+                try:
+                    for record in BINARY_RECORD.iter_unpack(chunk):
+                        yield offset, decode_event(record)
+                        offset += BINARY_RECORD.size
+                except struct.error:
+                    raise Exception(f"Failed to parse {path}: truncated binary record")
+            return
+
+        offset = f.seek(start)
+        for line in f:
+            if end is not None and offset >= end:
+                break
+            if line.strip():
+                try:
+                    yield offset, json.loads(line)
+                except json.JSONDecodeError as exc:
+                    raise Exception(f"Failed to parse the event at byte {offset} of {path}: {exc}")
+            offset += len(line)
+
+def cancelled_entry_uuids(path : Path) -> Set[str]:
+    """ The ids of the entries removed by an RM_ENTRY in the event history at path. Only the
+    RM_ENTRY records are decoded, so this costs much less than a full parse.
+    """
+    cancelled = set()
+    if not path.exists():
+        return cancelled
+
+    with open(path, "rb") as f:
+        if detect_event_history_format(path) == BINARY:
+            f.seek(len(BINARY_MAGIC))
+            rm_code = EVENT_TYPE_CODES["RM_ENTRY"]
+            for chunk in iter(lambda: f.read(BINARY_CHUNK), b""):
+                try:
+                    cancelled.update(_bytes_to_uuid(x[5]) for x in BINARY_RECORD.iter_unpack(chunk) if x[1] == rm_code)
+                except struct.error:
+                    raise Exception(f"Failed to parse {path}: truncated binary record")
+            return cancelled
+
+        for line in f:
+            if b"RM_ENTRY" in line:
+                event = json.loads(line)
+                if event['event'] == "RM_ENTRY":
+                    cancelled.add(event['target_entry_uuid'])
+
+    return cancelled
+
+@trace.traced("compact")
+def compact_event_history(path : Path) -> Tuple[int, int]:
+    """ Drops every ADD_ENTRY that a later RM_ENTRY cancels from the event history at path,
+    rewriting it atomically in the same format.
+
+    The RM_ENTRY events themselves are kept as tombstones: other devices may still hold the
+    ADD_ENTRY, and as merge_event_histories deduplicates by id, it would otherwise bring the
+    removed entry back the next time the histories are merged.
+
+    Returns the number of events before and after compaction.
+    """
+    cancelled = cancelled_entry_uuids(path)
+
+    before = 0
+    def kept_events():
+        nonlocal before
+        for event in iter_event_history(path):
+            before += 1
+            if event['event'] == "ADD_ENTRY" and event['id'] in cancelled:
+                continue
+            yield event
+
+    tmp = path.with_name(path.name + ".tmp")
+    after = write_event_history(tmp, kept_events(), detect_event_history_format(path))
+    tmp.replace(path)
+
+    # The offsets in the index no longer match, so drop it rather than risk a stale lookup
+    event_index_path(path).unlink(missing_ok=True)
+
+    return before, after
+
+def detect_event_history_format(path : Path) -> str:
+    """ The format of an existing event history, JSONL if it doesn't exist (or is empty). """
+    if not path.exists():
+        return JSONL
+
+    with open(path, "rb") as f:
+        return BINARY if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC else JSONL
+
+def encode_event(event : Dict[str, Any]) -> bytes:
+    """ Encodes an event as a BINARY_RECORD, raising a ValueError if it can't be decoded
+    back to an identical event (unexpected fields, non-canonical UUIDs, out of range values).
+    """
+    if event['event'] == "ADD_ENTRY":
+        fields = ("id", "event", "problem_id", "confidence", "ts")
+        problem_id, confidence, target = event['problem_id'], event['confidence'], NULL_UUID
+    elif event['event'] == "RM_ENTRY":
+        fields = ("id", "event", "target_entry_uuid", "ts")
+        problem_id, confidence, target = 0, 0, _uuid_to_bytes(event['target_entry_uuid'])
+    else:
+        raise ValueError(f"Unexpected 'event' of type {event['event']}")
+
+    if set(event) != set(fields):
+        raise ValueError(f"Event {event.get('id')} has fields {sorted(event)}, expected {sorted(fields)}")
+
+    try:
+        return BINARY_RECORD.pack(
+            _uuid_to_bytes(event['id']), EVENT_TYPE_CODES[event['event']],
+            problem_id, confidence, event['ts'], target
+        )
+    except struct.error as exc:
+        raise ValueError(f"Event {event['id']} can't be stored in the binary format: {exc}")
+
+def decode_event(record : Tuple[bytes, int, int, int, int, bytes]) -> Dict[str, Any]:
+    """ Decodes an unpacked BINARY_RECORD, with the same fields (and field order) as
+    access.create_add_entry_event / access.create_rm_entry_event.
+    """
+    event_id, code, problem_id, confidence, ts, target = record
+
+    if code == 1:
+        return {
+            "id": _bytes_to_uuid(event_id),
+            "event": "ADD_ENTRY",
+            "problem_id": problem_id,
+            "confidence": confidence,
+            "ts": ts
+        }
+    elif code == 2:
+        return {
+            "id": _bytes_to_uuid(event_id),
+            "event": "RM_ENTRY",
+            "target_entry_uuid": _bytes_to_uuid(target),
+            "ts": ts
+        }
+    else:
+        raise ValueError(f"Unexpected event type code {code}")
+
+def _uuid_to_bytes(value : str) -> bytes:
+    raw = bytes.fromhex(value.replace("-", ""))
+    if len(raw) != 16 or _bytes_to_uuid(raw) != value:
+        raise ValueError(f"{value!r} is not a canonical (lowercase, hyphenated) UUID")
+    return raw
+
+def _bytes_to_uuid(raw : bytes) -> str:
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+def iter_event_history(path : Path) -> Iterator[Dict[str, Any]]:
+    """ Streams the events of an event history, in either format (auto-detected). """
+    if not path.exists():
+        return
+
+    if detect_event_history_format(path) == BINARY:
+        with open(path, "rb") as f:
+            f.seek(len(BINARY_MAGIC))
+            for chunk in iter(lambda: f.read(BINARY_CHUNK), b""):
+                try:
+                    yield from map(decode_event, BINARY_RECORD.iter_unpack(chunk))
+                except struct.error:
+                    raise Exception(f"Failed to parse {path}: truncated binary record")
+        return
+
     with open(path, "r", encoding="utf-8") as f:
         for ln, line in enumerate(f, 1): 
             line = line.strip() 
             if not line:
                 continue
             try:
-                events.append(json.loads(line))
+                yield json.loads(line)
             except json.JSONDecodeError as exc:
-                raise Exception(f"Failed to parse ln {ln} of {f}: {exc}") 
+                raise Exception(f"Failed to parse ln {ln} of {path}: {exc}") 
+
+def load_event_history(path : Path) -> List[Dict[str, Any]]:
+    return list(iter_event_history(path))
+
+@trace.traced("publish")
+def publish_event_history(src : Path, targets : List[Path]) -> None:
+    """ Atomically replaces each of the targets with a copy of src (src is consumed). """
+    for target in targets[:-1]:
+        tmp = target.with_name(target.name + ".tmp")
+        shutil.copyfile(src, tmp)
+        tmp.replace(target)
 
-    return events            
+    src.replace(targets[-1])
+
+def write_event_history(loc : Path, event_history : Iterable[Dict[str, Any]], fmt : str = JSONL) -> int:
+    """ Writes the events to loc, in the given format. Returns the number of events written. """
+    count = 0
+
+    if fmt == BINARY:
+        with open(loc, 'wb') as f:
+            f.write(BINARY_MAGIC)
+            for event in event_history:
+                f.write(encode_event(event))
+                count += 1
+        return count
 
-def write_event_history(loc : Path, event_history : List[str, Any]) -> None:
     with open(loc, 'w', encoding="utf-8") as f:
         for event in event_history: 
             line = json.dumps(event)
             f.write(line + '\n')
+            count += 1
 
-def reset_local_state() -> None:
-    events = load_event_history(LOCAL_EVENT_HISTORY)    
-    sm2_states : Dict[int, Tuple[int, float, int]] = {} # problem_id -> SM2 state (n, EF, I, last_review_ts, next_review_ts)
+    return count
 
-    for e in events:
-        problem_id, event, confidence, ts = (
-            e['problem_id'], e['event'], e['confidence'], e['ts']
-        )
+def append_events(path : Path, events : List[Dict[str, Any]]) -> None:
+    """ Appends the events to the event history at path, in the format it is already stored
+    in, and adds them to its index (if the index is up to date).
+    """
+    if detect_event_history_format(path) == BINARY:
+        records = [encode_event(event) for event in events]
+    else:
+        records = [(json.dumps(event) + '\n').encode("utf-8") for event in events]
+
+    index_is_current = is_event_index_current(path)
+
+    with open(path, "ab") as f:
+        offset = f.tell()
+        f.write(b"".join(records))
+
+    if index_is_current:
+        with open(event_index_path(path), "ab") as f:
+            for event, record in zip(events, records):
+                f.write(EVENT_INDEX_RECORD.pack(_event_index_key(event['id']), offset, len(record), event['ts']))
+                offset += len(record)
+
+def convert_event_history(src : Path, dest : Path, fmt : str) -> int:
+    """ Losslessly converts the event history at src to the given format, written to dest
+    (which may be src itself, replaced atomically). Returns the number of events converted.
+    """
+    tmp = dest.with_name(dest.name + ".tmp")
+    count = write_event_history(tmp, iter_event_history(src), fmt)
+    tmp.replace(dest)
+
+    return count
+
+def event_index_path(path : Path) -> Path:
+    return path.with_name(path.name + ".idx")
+
+def _event_index_key(event_id : str) -> bytes:
+    return hashlib.blake2b(event_id.encode("utf-8"), digest_size=16).digest()
+
+def build_event_index(path : Path) -> int:
+    """ (Re)builds the index of the event history at path with a full scan of it.
+    Returns the number of events indexed.
+    """
+    records = []
+    offset = 0
+
+    if path.exists():
+        with open(path, "rb") as f:
+            if detect_event_history_format(path) == BINARY:
+                offset = f.seek(len(BINARY_MAGIC))
+                for chunk in iter(lambda: f.read(BINARY_CHUNK), b""):
+                    for record in BINARY_RECORD.iter_unpack(chunk):
+                        event = decode_event(record)
+                        records.append(EVENT_INDEX_RECORD.pack(_event_index_key(event['id']), offset, BINARY_RECORD.size, event['ts']))
+                        offset += BINARY_RECORD.size
+            else:
+                for line in f:
+                    if line.strip():
+                        event = json.loads(line)
+                        records.append(EVENT_INDEX_RECORD.pack(_event_index_key(event['id']), offset, len(line), event['ts']))
+                    offset += len(line)
+
+    _write_event_index(event_index_path(path), records, offset)
+
+    return len(records)
+
+def _write_event_index(idx : Path, records : List[bytes], log_size : int) -> None:
+    """ Atomically writes the index records (in any order) to idx, sorted by key, then by
+    offset, as covering the first log_size bytes of the history.
+    """
+    # The key leads each record, and the offset follows it, but is little-endian, so
+    # ties are broken on the unpacked offset rather than the raw bytes
+    records.sort(key=lambda x : (x[:16], EVENT_INDEX_RECORD.unpack(x)[1]))
+
+    tmp = idx.with_name(idx.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(EVENT_INDEX_MAGIC)
+        f.write(EVENT_INDEX_HEADER.pack(len(records), log_size))
+        f.write(b"".join(records))
+    tmp.replace(idx)
+
+def _sort_event_index(path : Path) -> None:
+    """ Sorts the unsorted tail of the (current) index of the event history at path into
+    the rest of it, without reading the history itself.
+    """
+    idx = event_index_path(path)
+    data = idx.read_bytes()
+    records = [data[pos:pos + EVENT_INDEX_RECORD.size] for pos in range(EVENT_INDEX_START, len(data), EVENT_INDEX_RECORD.size)]
+
+    _write_event_index(idx, records, path.stat().st_size)
+
+def is_event_index_current(path : Path) -> bool:
+    """ Whether the index covers the event history up to its last byte, i.e. nothing has
+    been appended without updating the index, and the history hasn't been rewritten
+    with a different length since. (A rewrite of the same length is caught when
+    find_event reads the record back.)
+    """
+    idx = event_index_path(path)
+    if not idx.exists():
+        return False
+
+    log_size = path.stat().st_size if path.exists() else 0
+    with open(idx, "rb") as f:
+        if f.read(len(EVENT_INDEX_MAGIC)) != EVENT_INDEX_MAGIC:
+            return False
+
+        header = f.read(EVENT_INDEX_HEADER.size)
+        index_size = f.seek(0, 2)
+        if len(header) < EVENT_INDEX_HEADER.size or (index_size - EVENT_INDEX_START) % EVENT_INDEX_RECORD.size:
+            return False
+
+        n_sorted, sorted_log_size = EVENT_INDEX_HEADER.unpack(header)
+        n_records = (index_size - EVENT_INDEX_START) // EVENT_INDEX_RECORD.size
+        if n_records < n_sorted:
+            return False
+
+        if n_records == n_sorted: # Nothing appended since the index was built
+            return sorted_log_size == log_size
+
+        # The last record appended ends where the history does
+        f.seek(-EVENT_INDEX_RECORD.size, 2)
+        _, offset, length, _ = EVENT_INDEX_RECORD.unpack(f.read(EVENT_INDEX_RECORD.size))
+
+    return offset + length == log_size
+
+def find_event(path : Path, event_id : str) -> Optional[Tuple[Dict[str, Any], int]]:
+    """ Looks up an event by id, without parsing the event history: the id is located in
+    the fixed-width index (a binary search of its sorted records, then a scan of the few
+    appended since), then only the record at its offset is read from the mmap-ed history.
+    The index is rebuilt first if it is missing or out of date.
+
+    Returns (event, byte offset), or None if there is no event with that id.
+    """
+    if not path.exists():
+        return None
+
+    key = _event_index_key(event_id)
+
+    for attempt in range(2):
+        if attempt or not is_event_index_current(path):
+            build_event_index(path)
+        elif _event_index_tail_length(event_index_path(path)) > EVENT_INDEX_TAIL_MAX:
+            _sort_event_index(path)
 
-        if event == "ADD_ENTRY":
-            if problem_id not in sm2_states:
-                n, EF, I = (0, 2.5, 0)
+        located = _find_in_event_index(event_index_path(path), key)
+        if located is None:
+            return None
 
-            n, EF, I = SM2(confidence, n, EF, I)
-            last_review_at = ts
-            next_review_at = last_review_at + int(I * 86400)
+        offset, length = located
+        event = _read_event_at(path, offset, length)
+        if event is not None and event['id'] == event_id:
+            return event, offset
 
-        elif event == "RM_ENTRY":
-            pass
+        # The history was rewritten since it was indexed, rebuild the index and try again
 
+    return None
+
+def _event_index_tail_length(idx : Path) -> int:
+    """ The number of records appended to the (current) index since it was last sorted. """
+    with open(idx, "rb") as f:
+        f.seek(len(EVENT_INDEX_MAGIC))
+        n_sorted, _ = EVENT_INDEX_HEADER.unpack(f.read(EVENT_INDEX_HEADER.size))
+        index_size = f.seek(0, 2)
+
+    return (index_size - EVENT_INDEX_START) // EVENT_INDEX_RECORD.size - n_sorted
+
+class _EventIndexKeys:
+    """ The keys of the sorted records of an mmap-ed index, as a sequence for bisect. """
+    def __init__(self, mm : mmap.mmap, n_sorted : int):
+        self.mm = mm
+        self.n_sorted = n_sorted
+
+    def __len__(self) -> int:
+        return self.n_sorted
+
+    def __getitem__(self, i : int) -> bytes:
+        pos = EVENT_INDEX_START + i * EVENT_INDEX_RECORD.size
+        return self.mm[pos:pos + 16]
+
+def _find_in_event_index(idx : Path, key : bytes) -> Optional[Tuple[int, int]]:
+    with open(idx, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        n_sorted, _ = EVENT_INDEX_HEADER.unpack_from(mm, len(EVENT_INDEX_MAGIC))
+
+        i = bisect.bisect_left(_EventIndexKeys(mm, n_sorted), key)
+        if i < n_sorted:
+            pos = EVENT_INDEX_START + i * EVENT_INDEX_RECORD.size
+            found, offset, length, _ = EVENT_INDEX_RECORD.unpack_from(mm, pos)
+            if found == key:
+                return offset, length
+
+        # Then the records appended since the index was sorted (a single C-level scan)
+        tail_start = EVENT_INDEX_START + n_sorted * EVENT_INDEX_RECORD.size
+        pos = mm.find(key, tail_start)
+        while pos != -1:
+            if (pos - tail_start) % EVENT_INDEX_RECORD.size == 0: # On a record boundary
+                _, offset, length, _ = EVENT_INDEX_RECORD.unpack_from(mm, pos)
+                return offset, length
+            pos = mm.find(key, pos + 1)
+
+    return None
+
+def _read_event_at(path : Path, offset : int, length : int) -> Optional[Dict[str, Any]]:
+    if offset + length > path.stat().st_size:
+        return None
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        try:
+            if mm[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+                return decode_event(BINARY_RECORD.unpack_from(mm, offset))
+            return json.loads(mm[offset:offset + length])
+        except (ValueError, struct.error):
+            return None
+
+def fold_event_history(events : Iterable[Dict[str, Any]],
+                       entries : Optional[Dict[str, Tuple[int, int, int]]] = None) -> Dict[str, Tuple[int, int, int]]:
+    """ Folds ADD_ENTRY / RM_ENTRY events, in order, into the set of surviving entries,
+    starting from entries (e.g. those of a state snapshot), which is updated in place.
+
+    Returns entry_uuid -> (problem_id, confidence, ts)
+    """
+    if entries is None:
+        entries = {}
+
+    for event in events:
+        if event['event'] == "ADD_ENTRY":
+            entries[event['id']] = (event['problem_id'], event['confidence'], event['ts'])
+        elif event['event'] == "RM_ENTRY":
+            entries.pop(event['target_entry_uuid'], None)
+        else:
+            raise Exception(f"Unexpected 'event' of type {event['event']}")
+
+    return entries
+
+@trace.traced("read_tail")
+def read_event_history_tail(path : Path,
+                            checkpoint : Optional[Tuple[int, int, str]] = None
+                            ) -> Optional[Tuple[List[Dict[str, Any]], Tuple[int, int, str]]]:
+    """ Reads the events stored after the checkpoint (offset, count, digest), in a single pass
+    over the file, along with the checkpoint covering the whole file.
+
+    Returns None if the file no longer starts with the checkpointed prefix, i.e. events
+    have been inserted, removed or reordered before the checkpoint.
+    """
+    offset, count, digest = 0, 0, hashlib.sha256()
+    events = []
+
+    if not path.exists():
+        return (events, (offset, count, digest.hexdigest())) if checkpoint is None else None
+
+    fmt = detect_event_history_format(path)
+
+    with open(path, "rb") as f:
+        if checkpoint is not None:
+            offset, count, expected_digest = checkpoint
+            remaining = offset
+            while remaining:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    return None # The file is shorter than the checkpoint
+                digest.update(chunk)
+                remaining -= len(chunk)
+
+            if digest.hexdigest() != expected_digest:
+                return None
+
+        if fmt == BINARY:
+            if offset == 0:
+                header = f.read(len(BINARY_MAGIC))
+                digest.update(header)
+                offset += len(header)
+            elif (offset - len(BINARY_MAGIC)) % BINARY_RECORD.size:
+                return None # The checkpoint isn't on a record boundary (e.g. taken before a conversion)
+
+            for chunk in iter(lambda: f.read(BINARY_CHUNK), b""):
+                digest.update(chunk)
+                offset += len(chunk)
+                try:
+                    events.extend(map(decode_event, BINARY_RECORD.iter_unpack(chunk)))
+                except struct.error:
+                    raise Exception(f"Failed to parse {path}: truncated binary record")
+
+            return events, (offset, count + len(events), digest.hexdigest())
+
+        for ln, line in enumerate(f, count + 1):
+            digest.update(line)
+            offset += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError as exc:
+                raise Exception(f"Failed to parse event {ln} of {path}: {exc}")
+            count += 1
+
+    return events, (offset, count, digest.hexdigest())
+
+def get_replay_checkpoint() -> Optional[Tuple[int, int, str]]:
+    return get_event_history_checkpoint(REPLAY_CHECKPOINT)
+
+def get_event_history_checkpoint(key : str) -> Optional[Tuple[int, int, str]]:
+    value = access.get_state(key)
+    if value is None:
+        return None
+
+    offset, count, digest = value.split(":")
+    return int(offset), int(count), digest
+
+def fmt_replay_checkpoint(checkpoint : Tuple[int, int, str]) -> str:
+    return ":".join(str(x) for x in checkpoint)
+
+def state_snapshot_paths() -> List[Path]:
+    """ The state snapshots, newest (covering the most events) first. """
+    if not STATE_SNAPSHOT_DIR.exists():
+        return []
+    return sorted(STATE_SNAPSHOT_DIR.glob("state-*.json"), reverse=True)
+
+def write_state_snapshot(checkpoint : Tuple[int, int, str],
+                         entries : Dict[str, Tuple[int, int, int]]) -> Path:
+    """ Atomically writes a snapshot of the state derived from the first checkpoint[1] events of
+    LOCAL_EVENT_HISTORY: the surviving entries. Only the newest SNAPSHOT_KEEP snapshots are kept.
+    """
+    STATE_SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+
+    path = STATE_SNAPSHOT_DIR / f"state-{checkpoint[1]:012d}.json"
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        # json.dumps rather than json.dump, which can't use the C encoder when streaming
+        f.write(json.dumps({
+            "checkpoint": checkpoint,
+            "entries": [(entry_uuid, *entry) for entry_uuid, entry in entries.items()],
+        }, separators=(",", ":")))
+    tmp.replace(path)
+
+    for stale in state_snapshot_paths()[SNAPSHOT_KEEP:]:
+        stale.unlink(missing_ok=True)
+
+    return path
+
+def load_state_snapshot(path : Path) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], Tuple[int, int, str]]]:
+    """ Loads the newest state snapshot that LOCAL_EVENT_HISTORY still starts with, deleting any
+    newer ones that it no longer does (e.g. after a merge inserted older events, or a compaction),
+    as they can never match again.
+
+    Returns (snapshot, events after the snapshot, checkpoint covering the whole file), or None
+    if there is no usable snapshot.
+    """
+    for snapshot_path in state_snapshot_paths():
+        try:
+            with open(snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            tail = read_event_history_tail(path, tuple(snapshot["checkpoint"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            tail = None
+
+        if tail is not None:
+            return snapshot, *tail
+
+        snapshot_path.unlink(missing_ok=True)
+
+    return None
+
+def snapshot_due(checkpoint : Tuple[int, int, str]) -> bool:
+    snapshots = state_snapshot_paths()
+    latest = int(snapshots[0].stem.split("-")[1]) if snapshots else 0
+
+    return checkpoint[1] - latest >= SNAPSHOT_INTERVAL
+
+@trace.traced("rebuild")
 def update_state_from_local_event_history() -> None:
     """
+    Rebuilds the entries table and the SM-2 state of every problem from LOCAL_EVENT_HISTORY.
+
     Steps:
-    1. Clear the entries database table
-    2. Run through the events stored under LOCAL_EVENT_HISTORY updating the entries database table
-    3. Wipe the problem state for all problems
-    4. Run through every entry within entries in chronological order to derive the correct state of each problem
+    1. Fold the ADD_ENTRY / RM_ENTRY events stored under LOCAL_EVENT_HISTORY into the surviving entries (in memory),
+       starting from the latest state snapshot the history still matches, if there is one
+    2. Replay the entries of each problem in chronological order to derive its SM-2 state, and that after each entry
+    3. Write the entries, their states, problem states and replay checkpoint to the database in a single transaction
+    4. Take a new state snapshot, if SNAPSHOT_INTERVAL events have been added since the latest one
+
+    Unlike access.insert_entry / rm_entry, nothing is appended back to the event history.
     """
-    
-    access.clear_entries_table()
+    loaded = load_state_snapshot(LOCAL_EVENT_HISTORY)
+
+    if loaded is None:
+        events, checkpoint = read_event_history_tail(LOCAL_EVENT_HISTORY)
+        entries = fold_event_history(events)
+
+    else:
+        snapshot, events, checkpoint = loaded
+        entries = fold_event_history(events, {x[0]: tuple(x[1:]) for x in snapshot["entries"]})
 
-    # 1. Load all events from the local version of the event history
-    events = load_event_history(LOCAL_EVENT_HISTORY)    
+    access.replace_entries_and_states(
+        [(entry_uuid, *entry) for entry_uuid, entry in entries.items()],
+        {REPLAY_CHECKPOINT: fmt_replay_checkpoint(checkpoint)}
+    )
+
+    if snapshot_due(checkpoint):
+        write_state_snapshot(checkpoint, entries)
+
+@trace.traced("replay")
+def sync_state_from_local_event_history() -> bool:
+    """
+    Brings the database up to date with LOCAL_EVENT_HISTORY, replaying only the events
+    appended since the last replay checkpoint, and recalculating the SM-2 state of only
+    the problems they touch.
 
-    # 2. Process all events in chronological order
+    Falls back to a full rebuild when there is no checkpoint, or when the log no longer
+    starts with the checkpointed prefix (e.g. a merge inserted older events before it).
+
+    Returns True if the update was incremental, False if the state was fully rebuilt.
+    """
+    checkpoint = get_replay_checkpoint()
+    tail = read_event_history_tail(LOCAL_EVENT_HISTORY, checkpoint) if checkpoint else None
+
+    if tail is None:
+        update_state_from_local_event_history()
+        return False
+
+    events, new_checkpoint = tail
+
+    new_entries : Dict[str, Tuple[str, int, int, int]] = {}
+    removed : List[str] = []
     for event in events:
-        access.process_event(event)
-    
-    # 3. Update the state of all problems based of the entries under the entries table
-    entries = access.get_all_entries() 
+        if event['event'] == "ADD_ENTRY":
+            new_entries[event['id']] = (event['id'], event['problem_id'], event['confidence'], event['ts'])
+        elif event['event'] == "RM_ENTRY":
+            new_entries.pop(event['target_entry_uuid'], None)
+            removed.append(event['target_entry_uuid'])
+        else:
+            raise Exception(f"Unexpected 'event' of type {event['event']}")
+
+    access.apply_entry_changes(
+        list(new_entries.values()),
+        removed,
+        {REPLAY_CHECKPOINT: fmt_replay_checkpoint(new_checkpoint)}
+    )
+
+    if snapshot_due(new_checkpoint):
+        entries = {x[0]: tuple(x[1:]) for x in access.get_all_entries()}
+        write_state_snapshot(new_checkpoint, entries)
+
+    return True
+
+def get_device_id() -> str:
+    """ This device's id, generated the first time it is needed. """
+    device_id = access.get_state(DEVICE_ID)
+    if device_id is None:
+        import uuid
+
+        device_id = uuid.uuid4().hex[:12]
+        with access.transaction() as con:
+            access.set_state(con, DEVICE_ID, device_id)
+
+    return device_id
+
+def read_manifest(device_dir : Path) -> Dict[str, Any]:
+    """ The manifest of a device's segments: {"device": id, "segments": [{"name", "events", "first_ts",
+    "last_ts", "sha256"}, ...]}, in the order they were written.
+    """
+    manifest = device_dir / MANIFEST
+    if not manifest.exists():
+        return {"device": device_dir.name, "segments": []}
+
+    with open(manifest, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def backup_segment_paths() -> List[Path]:
+    """ Every segment of the backup, across all devices, plus the backup from before it was
+    split into segments (if there is one). Merged, they make up the backed up history.
+
+    Only the segments listed in a manifest are included, so a segment whose commit was
+    interrupted is never read half written.
+    """
+    paths = [BACKUP_EVENT_HISTORY] if BACKUP_EVENT_HISTORY.exists() else []
+
+    if BACKUP_SEGMENTS_DIR.exists():
+        for device_dir in sorted(x for x in BACKUP_SEGMENTS_DIR.iterdir() if x.is_dir()):
+            paths.extend(device_dir / x["name"] for x in read_manifest(device_dir)["segments"])
+
+    return paths
+
+def write_backup_segment(events : List[Dict[str, Any]], fmt : str = JSONL) -> List[Path]:
+    """ Writes the events, sorted, to a new segment in this device's directory of the backup,
+    named after the month it was written in, and lists it in the device's manifest. Existing
+    segments are never modified, so a sync only adds a file and touches the (small) manifest.
+
+    Returns the paths of the segment and the manifest, relative to the backup repository.
+    """
+    device_dir = BACKUP_SEGMENTS_DIR / get_device_id()
+    device_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = read_manifest(device_dir)
+    window = datetime.datetime.now().strftime("%Y-%m")
+    seq = sum(x["name"].startswith(window) for x in manifest["segments"])
+    segment = device_dir / f"{window}-{seq:04d}.{'bin' if fmt == BINARY else 'jsonl'}"
+
+    events = sorted(events, key=event_key)
+    write_event_history(segment, events, fmt)
+
+    with open(segment, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
 
-    sm2_states : Dict[int, Tuple[int, float, int]] = {} # problem_id -> SM2 state (n, EF, I, last_review_ts, next_review_ts)
+    manifest["segments"].append({
+        "name": segment.name,
+        "events": len(events),
+        "first_ts": events[0]['ts'],
+        "last_ts": events[-1]['ts'],
+        "sha256": sha256,
+    })
 
-    for _, problem_id, confidence, ts in entries:    
-        if problem_id not in sm2_states:
-            n, EF, I = (0, 2.5, 0)
-        n, EF, I = SM2(confidence, n, EF, I)
-        last_review_at = ts
-        next_review_at = last_review_at + int(I * 86400)
+    tmp = device_dir / (MANIFEST + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    tmp.replace(device_dir / MANIFEST)
 
-        sm2_states[problem_id] = (n, EF, I, last_review_at, next_review_at)
+    return [x.relative_to(BACKUP_SEGMENTS_DIR.parent) for x in (segment, device_dir / MANIFEST)]
 
-    new_states = [
-        (v[0], v[1], v[2], v[3], v[4], k) 
-        for k, v in sm2_states.items()
-    ]
+def unbacked_up_events(*extra : Path) -> List[Dict[str, Any]]:
+    """ The events of LOCAL_EVENT_HISTORY (and any extra histories) that aren't in the backup yet.
 
-    access.bulk_update_SM2_state(new_states)
+    Usually these are just the events appended since the last sync, read from BACKUP_CHECKPOINT
+    onwards. If the local history has been rewritten since (e.g. compacted or converted), or
+    there are extra histories, they are found by comparing ids with the whole backup instead.
+    """
+    checkpoint = get_event_history_checkpoint(BACKUP_CHECKPOINT)
+    if checkpoint is not None and not extra:
+        tail = read_event_history_tail(LOCAL_EVENT_HISTORY, checkpoint)
+        if tail is not None:
+            return tail[0]
+
+    backed_up = {event['id'] for path in backup_segment_paths() for event in iter_event_history(path)}
+
+    events = {}
+    for path in (LOCAL_EVENT_HISTORY, *extra):
+        for event in iter_event_history(path):
+            if event['id'] not in backed_up:
+                events[event['id']] = event
+
+    return list(events.values())
+
+def checkpoint_event_history(path : Path) -> Tuple[int, int, str]:
+    """ The checkpoint (offset, count, digest) covering the whole of an event history, as
+    read_event_history_tail would return, without parsing its events.
+    """
+    offset, count, digest = 0, 0, hashlib.sha256()
+    if not path.exists():
+        return offset, count, digest.hexdigest()
+
+    binary = detect_event_history_format(path) == BINARY
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+            offset += len(chunk)
+            if not binary:
+                count += chunk.count(b"\n")
+
+    if binary:
+        count = (offset - len(BINARY_MAGIC)) // BINARY_RECORD.size
+
+    return offset, count, digest.hexdigest()
+
+def is_event_history_unchanged(path : Path, checkpoint : Optional[Tuple[int, int, str]]) -> bool:
+    """ Whether the event history at path is exactly the one the checkpoint covers. The size is
+    compared first, so a history that has been appended to is detected without reading it.
+    """
+    if checkpoint is None:
+        return False
 
+    size = path.stat().st_size if path.exists() else 0
+    if size != checkpoint[0]:
+        return False
 
+    return checkpoint_event_history(path)[2] == checkpoint[2]
@@ -1,22 +1,21 @@
 import re
+import json
 import logging
 import datetime
 import typer
 import click
-import random
-import github
-import git
-import uuid
 
 
-from .sm2 import SM2 
 from . import access
 from .utility import initial_sync
-from . import github_client
-from .constants import BACKUP_REPO_DIR, BACKUP_EVENT_HISTORY, LOCAL_EVENT_HISTORY, TMP_EVENT_HISTORY
+from . import utility
+from .constants import BACKUP_REPO_DIR, LOCAL_EVENT_HISTORY, TMP_EVENT_HISTORY, CATALOGUE_SNAPSHOT
 from . import backup
+from . import trace
+from . import scheduler
 
-from typing import Any, Dict, Tuple, List
+from pathlib import Path
+from typing import Any, Dict, Tuple, List, Optional
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 app = typer.Typer(add_completion=False)
@@ -30,28 +29,81 @@ colours = {
 def fmt_date(ts):
     return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts else "Never"
 
+def start_profiling(ctx : typer.Context, profile_out : Optional[Path]) -> None:
+    """ Times the phases of the invoked command, printing the table (and writing the cProfile
+    stats to profile_out) once it finishes. Also enabled by the LCTRACK_TRACE environment variable.
+    """
+    trace.enable()
+
+    # The context's callbacks run last in, first out: the command's span is closed, then the
+    # profiler stopped, then the table printed
+    ctx.call_on_close(trace.report)
+
+    if profile_out is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+
+        def stop() -> None:
+            profiler.disable()
+            profiler.dump_stats(profile_out)
+            typer.echo(f"Profile written to {profile_out} (view with `python -m pstats {profile_out}`)", err=True)
+
+        ctx.call_on_close(stop)
+        profiler.enable()
+
+    ctx.with_resource(trace.span(ctx.invoked_subcommand or "lc-track"))
+
 @app.callback()
-def main():
+def main(
+    ctx: typer.Context,
+    profile: bool = typer.Option(False, "--profile", help="Print the wall / CPU time, SQL statements and I/O of each phase of the command."),
+    profile_out: Optional[Path] = typer.Option(None, "--profile-out", help="With --profile, also write cProfile stats to this file."),
+):
     """
     LeetCode-Track CLI
     """
-    if not access.db_exists():
-        access.init_db()
-        logging.info("lc-track database initialised.") 
-
+    if profile or trace.enabled:
+        start_profiling(ctx, profile_out)
+
+    with trace.span("startup"):
+        is_new_db = not access.db_exists()
+        schema_version, initial_sync_state = (0, None) if is_new_db else access.get_startup_state()
+
+        # Creates the schema, or applies any pending schema upgrades to an existing database
+        if schema_version < len(access.SCHEMA_UPGRADES):
+            access.init_db()
+            if is_new_db:
+                logging.info("lc-track database initialised.") 
+
+        # A new database is filled from the bundled snapshot, in one transaction, so the first run
+        # never waits on the network. The snapshot only holds the LC250 problems (without topics),
+        # so the complete catalogue is left to `lc-track refresh-catalogue` or the next sync.
+        if initial_sync_state is None and initial_sync() is not None and access.get_state("initial_sync") != "complete":
+            logging.info(
+                "Loaded the LC250 problems from the bundled catalogue. "
+                "Run `lc-track refresh-catalogue` to fetch the complete catalogue, with topics."
+            )
+
+def no_problem_found(id : int) -> None:
+    typer.echo(f"No problem found with id: {id}")
     if access.get_state("initial_sync") != "complete":
-        initial_sync()
+        typer.echo("Only part of the problem catalogue has been loaded. Run `lc-track refresh-catalogue` to fetch the rest.")
 
 @app.command(name="study")
-def study():
-    """Picks a problem at random from the set of active problems that are due for review."""
-    problems = access.get_for_review_problems()
-
-    if not problems:
+def study(
+    pick_random: bool = typer.Option(False, "--random", help="Pick a due problem at random, rather than the most urgent one."),
+):
+    """Picks the most urgent problem from the set of active problems that are due for review."""
+    if pick_random:
+        chosen = scheduler.random_due()
+    else:
+        queue = scheduler.review_queue(limit=1)
+        chosen = queue[0] if queue else None
+
+    if chosen is None:
         typer.echo("No problems due for review.")
         return
-
-    chosen = random.choice(problems)
     
     color_code = colours.get(chosen.difficulty_txt, "37")
 
@@ -61,7 +113,7 @@ def study():
 def set_pat():
     PAT = input("Enter github PAT token:").strip()
 
-    with access.get_db_connection() as con:
+    with access.transaction() as con:
         access.set_state('PAT')
 
 import typer
@@ -84,30 +136,140 @@ def ls_active():
         typer.echo(f"LC{p.id:<4}. {p.title:<35} [\033[{color_code}m{p.difficulty_txt}\033[0m] \033[1m\033[0m")
 
 @app.command(name="ls-review")
-def ls_for_review():
-    """ List all problems, within the active set, currently due for review. """
-    due_problems = access.get_for_review_problems()
+def ls_for_review(
+    limit: Optional[int] = typer.Option(None, "--limit", "-n", min=1, help="Only list the N most urgent problems."),
+    plan: Optional[int] = typer.Option(None, "--plan", min=1, help="List a queue of N problems for today: the due problems, topped up with those due soonest."),
+    seed: Optional[int] = typer.Option(None, "--seed", help="With --plan, shuffle problems of similar urgency (reproducibly, for the same seed)."),
+):
+    """ List the problems, within the active set, currently due for review, most urgent first. """
+    if plan is not None:
+        queue = scheduler.plan(plan, seed)
+        if not queue:
+            typer.echo("Your active study set is empty. Use 'lc-track activate <id>' to add some!")
+            return
+
+        typer.echo(f"\033[1;94mToday's plan:\033[0m {len(queue)} problems")
+        for p in queue:
+            color_code = colours.get(p.difficulty_txt, "37")
+            typer.echo(f"LC{p.id:<4}. {p.title:<35} [\033[{color_code}m{p.difficulty_txt}\033[0m] due {fmt_date(p.next_review_at)}")
+        return
 
-    if not due_problems:
+    n_due = scheduler.count_due()
+    if not n_due:
         typer.echo("No problems due for review. You're all caught up!")
         return
 
+    due_problems = scheduler.review_queue(limit)
+
     # Using your bold blue style for the header
-    typer.echo(f"\033[1;94mTo review:\033[0m {len(due_problems)} problems pending")
+    typer.echo(f"\033[1;94mTo review:\033[0m {n_due} problems pending")
     
     for p in due_problems:
         color_code = colours.get(p.difficulty_txt, "37")
         # Kept the padding and removed the trailing blue bracket bug
         typer.echo(f"LC{p.id:<4}. {p.title:<35} [\033[{color_code}m{p.difficulty_txt}\033[0m]")
 
+@app.command(name="forecast")
+def forecast(
+    days: int = typer.Option(14, "--days", "-d", min=1, help="Number of days to forecast, starting today."),
+    simulate: bool = typer.Option(False, "--simulate", help="Also count the repeat reviews that come due within the forecast, simulating SM-2."),
+    confidence: Optional[str] = typer.Option(None, "--confidence", help="With --simulate, the assumed confidence distribution as confidence:weight pairs, e.g. 3:1,4:2,5:1. Defaults to that of your review history."),
+    seed: Optional[int] = typer.Option(None, "--seed", help="With --simulate, seed the random confidences (for reproducible output)."),
+):
+    """ Forecast the number of reviews due on each of the coming days. """
+    weights = None
+    if confidence is not None:
+        try:
+            weights = utility.parse_confidence_weights(confidence)
+        except ValueError as e:
+            typer.echo(f"Error: Invalid --confidence: {e}")
+            raise typer.Exit(code=1)
+
+    now = scheduler.now_ts()
+    scheduled = scheduler.forecast(days, now)
+    simulated = scheduler.simulate_forecast(days, weights, seed, now) if simulate else None
+
+    if not any(simulated or scheduled):
+        typer.echo(f"No active problems due within the next {days} days.")
+        return
+
+    counts = simulated or scheduled
+    scale = max(1, max(counts) / 40) # Keeps the bars within 40 columns
+
+    header = f"\033[1m{'date':<10} {'due':>5}"
+    typer.echo(header + (f" {'simulated':>9}\033[0m" if simulate else "\033[0m"))
+
+    day = datetime.date.fromtimestamp(now)
+    for i, count in enumerate(counts):
+        row = f"{(day + datetime.timedelta(days=i)).isoformat():<10} {scheduled[i]:>5}"
+        if simulate:
+            row += f" {count:>9}"
+        typer.echo(f"{row}  {'#' * round(count / scale)}")
+
+    total = f"{sum(scheduled)} problems due"
+    if simulate:
+        total += f", {sum(simulated)} reviews simulated"
+    typer.echo(f"\033[1;94mNext {days} days:\033[0m {total}")
+
+def set_active_many(active : bool,
+                    ids : Optional[List[str]],
+                    topics : Optional[List[str]],
+                    difficulty : Optional[str],
+                    list_file : Optional[Path]) -> None:
+    """ Activates / deactivates every problem selected by the ids (and ranges) and list file,
+    narrowed down by topic and difficulty, with a single UPDATE, then prints a summary.
+    """
+    selected = None
+    try:
+        if ids or list_file:
+            selected = utility.parse_id_args(ids or [])
+            if list_file:
+                selected += utility.read_id_list(list_file)
+    except (OSError, ValueError) as exc:
+        typer.echo(f"Error: {exc}")
+        raise typer.Exit(1)
+
+    if selected is None and not topics and difficulty is None:
+        typer.echo("Error: Give problem ids, or at least one of --topic, --difficulty or --list.")
+        raise typer.Exit(1)
+
+    matched, changed = access.set_active_where(
+        active, selected, topics, utility.DIFF_TO_INT[difficulty.capitalize()] if difficulty else None
+    )
+
+    action = "Added" if active else "Removed"
+    preposition = "to" if active else "from"
+    typer.echo(f"\033[1;94m{action} {changed} problems {preposition} the active set.\033[0m")
+
+    if matched > changed:
+        typer.echo(f"{matched - changed} selected problems were already {'active' if active else 'inactive'}.")
+    if selected is not None:
+        missing = len(set(selected) - access.get_existing_problem_ids(selected))
+        if missing:
+            typer.echo(f"{missing} ids didn't match any problem.")
+
+DIFFICULTY_CHOICE = click.Choice(["easy", "medium", "hard"], case_sensitive=False)
 
 @app.command(name="activate")
-def activate(id: int) -> None:
-    """ Add a problem (by its id) to the active study set. """
+def activate(
+    ids: Optional[List[str]] = typer.Argument(None, help="Problem ids or ranges, e.g. 1 2 10-20."),
+    topics: Optional[List[str]] = typer.Option(None, "--topic", help="Only problems with this topic slug (e.g. graph). Repeatable."),
+    difficulty: Optional[str] = typer.Option(None, "--difficulty", click_type=DIFFICULTY_CHOICE, help="Only problems of this difficulty."),
+    list_file: Optional[Path] = typer.Option(None, "--list", help="File of problem ids, one per line or in the LC250.csv layout."),
+) -> None:
+    """ Add problems to the active study set: by id, or in bulk by range, topic, difficulty
+    or list file (e.g. `activate --list LC250.csv`, `activate --topic graph --difficulty medium`).
+    """
+    if ids and len(ids) == 1 and ids[0].isdigit() and not (topics or difficulty or list_file):
+        activate_one(int(ids[0]))
+    else:
+        set_active_many(True, ids, topics, difficulty, list_file)
+
+def activate_one(id: int) -> None:
     problem = access.get_problem(id)
     
     if not problem:
-        typer.echo(f"No problem found with id: {id}")
+        no_problem_found(id)
         return
 
     color_code = colours.get(problem.difficulty_txt, "37")
@@ -122,12 +284,25 @@ def activate(id: int) -> None:
     typer.echo(f"\033[1;94mAdded to active set:\033[0m LC{problem.id}. {problem.title} [\033[{color_code}m{problem.difficulty_txt}\033[0m]")
 
 @app.command(name="deactivate")
-def deactivate(id: int) -> None:
-    """ Remove a problem (by its id) from the active study set. """
+def deactivate(
+    ids: Optional[List[str]] = typer.Argument(None, help="Problem ids or ranges, e.g. 1 2 10-20."),
+    topics: Optional[List[str]] = typer.Option(None, "--topic", help="Only problems with this topic slug (e.g. graph). Repeatable."),
+    difficulty: Optional[str] = typer.Option(None, "--difficulty", click_type=DIFFICULTY_CHOICE, help="Only problems of this difficulty."),
+    list_file: Optional[Path] = typer.Option(None, "--list", help="File of problem ids, one per line or in the LC250.csv layout."),
+) -> None:
+    """ Remove problems from the active study set: by id, or in bulk by range, topic,
+    difficulty or list file.
+    """
+    if ids and len(ids) == 1 and ids[0].isdigit() and not (topics or difficulty or list_file):
+        deactivate_one(int(ids[0]))
+    else:
+        set_active_many(False, ids, topics, difficulty, list_file)
+
+def deactivate_one(id: int) -> None:
     problem = access.get_problem(id)
     
     if not problem:
-        typer.echo(f"No problem found with id: {id}")
+        no_problem_found(id)
         return
 
     color_code = colours.get(problem.difficulty_txt, "37")
@@ -149,7 +324,7 @@ def details(id: int) -> None:
     topics = access.get_problem_topics(id)
     
     if not problem: 
-        typer.echo(f"No problem found with id: {id}")
+        no_problem_found(id)
         return
 
     BW = "\033[1;37m"        # Bold White
@@ -168,6 +343,73 @@ def details(id: int) -> None:
     typer.echo(f"Repetitions: {problem.n}")
     typer.echo(f"Easiness:    {problem.ef:.2f}\n")
 
+@app.command(name="shell")
+def shell() -> None:
+    """ Start an interactive session: every command, plus next / rate 0-5 / skip through the due
+    queue, run in this one process, with the catalogue and queue held in memory.
+    """
+    from . import shell # cmd and readline are only needed here
+
+    shell.run(typer.main.get_command(app))
+
+@app.command(name="stats")
+def stats(
+    all_topics: bool = typer.Option(False, "--all-topics", help="Also list topics without any active or reviewed problems."),
+) -> None:
+    """ Progress by difficulty and by topic: active, due and mastered problems, mean EF and reviews. """
+    by_difficulty, by_topic = access.get_stats()
+
+    def fmt_row(label : str, row : Tuple, width : int) -> str:
+        problems, active, due, reviewed, mastered, mean_ef, reviews = row
+        ef = f"{mean_ef:.2f}" if mean_ef is not None else "-"
+        return f"{label:<{width}} {problems:>8} {active:>7} {due:>5} {reviewed:>9} {mastered:>9} {ef:>8} {reviews:>8}"
+
+    def header(label : str, width : int) -> str:
+        return f"\033[1m{label:<{width}} {'problems':>8} {'active':>7} {'due':>5} {'reviewed':>9} {'mastered':>9} {'mean EF':>8} {'reviews':>8}\033[0m"
+
+    typer.echo(header("difficulty", 10))
+    for difficulty, *row in by_difficulty:
+        typer.echo(fmt_row(utility.INT_TO_DIFF[difficulty], row, 10))
+
+    topics = [x for x in by_topic if all_topics or x[2] or x[4]]
+    if topics:
+        width = max(len("topic"), *(len(x[0]) for x in topics))
+        typer.echo("\n" + header("topic", width))
+        for title, *row in topics:
+            typer.echo(fmt_row(title, row, width))
+
+    typer.echo(f"\n(mastered: reviewed, with an interval of at least {access.MASTERED_INTERVAL} days)")
+
+@app.command(name="search")
+def search(
+    query: List[str] = typer.Argument(..., help="Words to look for in problem titles, slugs and topics. Each matches as a prefix, e.g. `bin tree`."),
+    difficulty: Optional[str] = typer.Option(None, "--difficulty", click_type=DIFFICULTY_CHOICE, help="Only problems of this difficulty."),
+    active: Optional[bool] = typer.Option(None, "--active/--inactive", help="Only problems in / not in the active study set."),
+    due: bool = typer.Option(False, "--due", help="Only active problems due for review."),
+    limit: int = typer.Option(20, "--limit", "-n", min=1, help="Show at most N matches."),
+) -> None:
+    """ Find problems by title, slug or topic, best match first. """
+    try:
+        matches = access.search_problems(
+            " ".join(query),
+            utility.DIFF_TO_INT[difficulty.capitalize()] if difficulty else None,
+            active,
+            due,
+            limit
+        )
+    except ValueError as e:
+        typer.echo(f"Error: {e}")
+        raise typer.Exit(code=1)
+
+    if not matches:
+        typer.echo(f"No problems match '{' '.join(query)}'.")
+        return
+
+    for p in matches:
+        color_code = colours.get(p.difficulty_txt, "37")
+        marker = " \033[1;94m(active)\033[0m" if p.active else ""
+        typer.echo(f"LC{p.id:<4}. {p.title:<35} [\033[{color_code}m{p.difficulty_txt}\033[0m]{marker}")
+
 @app.command(name="add-entry")
 def add_entry(
     id: int,
@@ -179,40 +421,67 @@ def add_entry(
 
     problem = access.get_problem(id) 
     if not problem:
-        typer.echo(f"No problem found with id: {id}")
+        no_problem_found(id)
         raise typer.Exit(code=1)
 
-    # 1. Save the record
-    try:
+    import uuid
 
+    # 1. Save the record. This restates the problem's entries, updating its SM-2 state
+    try:
         record_id = access.insert_entry(str(uuid.uuid4()), id, confidence, now_unix_ts)
     except Exception as exc: 
         logging.error(f"Failed to insert entry into local database: {exc}")
         raise typer.Exit(1)
 
-    # 2. Get the problems current SM-2 state 
-    n, EF, I = problem.n, problem.ef, problem.i
-
-    # 3. Calculate the new SM2 state
-    n_new, EF_new, I_new = SM2(confidence, n, EF, I)
-    next_review_at = now_unix_ts + int(I_new * 86400)
-
-    # 4. Update the state of the problem
-    try:
-        access.update_SM2_state(id, n_new, EF_new, I_new, now_unix_ts, next_review_at)
-    except Exception as exc:
-        logging.error(f"Failed to update SM2 state of problem: {exc}")
-        raise typer.Exit(1)
+    # 2. Get the problem's new SM-2 state
+    problem = access.get_problem(id)
 
     typer.echo("-" * 30)
     typer.echo(f"Record Saved [ID: {record_id}]")
     typer.echo("-" * 30)
     typer.echo(f"{'Problem ID':<15}: {id}")
     typer.echo(f"{'Confidence':<15}: {confidence}/5")
-    typer.echo(f"{'Next Review':<15}: {fmt_date(next_review_at)} (in {I_new:.1f} days)")
-    typer.echo(f"{'New EF':<15}: {EF_new:.2f}")
+    typer.echo(f"{'Next Review':<15}: {fmt_date(problem.next_review_at)} (in {problem.i:.1f} days)")
+    typer.echo(f"{'New EF':<15}: {problem.ef:.2f}")
     typer.echo("-" * 30)
 
+@app.command(name="add-entries")
+def add_entries(
+    source: typer.FileText = typer.Argument("-", help="CSV of problem_id,confidence[,ts] rows, or - for stdin. ts is a unix timestamp or ISO date, and defaults to now."),
+) -> None:
+    """ Log many completions at once (e.g. to import old study notes), updating the SM-2
+    state of each problem once. Nothing is added unless every row is valid.
+    """
+    now_unix_ts = int(datetime.datetime.now().timestamp())
+    rows, errors = utility.read_entry_rows(source, now_unix_ts)
+
+    missing = {x[0] for x in rows} - access.get_existing_problem_ids(x[0] for x in rows)
+    if missing:
+        shown = ", ".join(str(x) for x in sorted(missing)[:10])
+        errors.append(f"No problem found with id(s): {shown}{f' and {len(missing) - 10} more' if len(missing) > 10 else ''}")
+
+    if errors:
+        for error in errors[:10]:
+            typer.echo(f"Error: {error}")
+        if len(errors) > 10:
+            typer.echo(f"... and {len(errors) - 10} more errors")
+        typer.echo("No entries were added.")
+        raise typer.Exit(1)
+
+    if not rows:
+        typer.echo("Status: No entries to add.")
+        return
+
+    import uuid
+
+    try:
+        touched = access.insert_entries([(str(uuid.uuid4()), *x) for x in rows])
+    except Exception as exc:
+        logging.error(f"Failed to insert entries into local database: {exc}")
+        raise typer.Exit(1)
+
+    typer.echo(f"Success: {len(rows)} entries added across {len(touched)} problems.")
+
 @app.command(name="rm-entry")
 def rm_entry(entry_uuid : str) -> None:
     """ Remove an entry and update the SM2 state.
@@ -221,11 +490,85 @@ def rm_entry(entry_uuid : str) -> None:
         problem_id = access.rm_entry(entry_uuid)
     except Exception as exc:
         logging.error(f"Failed to remove entry: {exc}")
+        if access.get_entry(entry_uuid) is None:
+            # The ADD_ENTRY of a removed entry stays in the history (until compacted), next to its RM_ENTRY
+            if entry_uuid in backup.cancelled_entry_uuids(LOCAL_EVENT_HISTORY):
+                logging.error("The entry has already been removed.")
+            elif backup.find_event(LOCAL_EVENT_HISTORY, entry_uuid):
+                logging.error("The entry is in the local event history, but not the database. Run `lc-track sync` to rebuild it.")
         raise typer.Exit(1)
 
     logging.info(f"Record {entry_uuid} removed. LC {problem_id} state recalculated.")
 
 
+@app.command(name="refresh-catalogue")
+def refresh_catalogue(
+    full: bool = typer.Option(False, "--full", help="Re-fetch the whole catalogue, picking up changes to existing problems too."),
+) -> None:
+    """ Fetch problems added to leetcode.com since the last catalogue sync.
+    Your study set and review history are left untouched.
+    """
+    changed = utility.refresh_catalogue(full)
+
+    if changed is None:
+        typer.echo("Error: Failed to refresh the problem catalogue.")
+        raise typer.Exit(1)
+
+    if not changed:
+        typer.echo("Status: Problem catalogue already up to date.")
+        return
+
+    typer.echo(f"Success: {changed} problems {'added or updated' if full else 'added'}.")
+
+@app.command(name="dump-catalogue", hidden=True)
+def dump_catalogue(dest: Path = typer.Argument(CATALOGUE_SNAPSHOT, help="Where to write the snapshot.")) -> None:
+    """ Write the current problem catalogue as a snapshot, for bundling with the package. """
+    count = utility.write_catalogue_snapshot(dest)
+    typer.echo(f"Success: {count} problems written to {dest}.")
+
+@app.command(name="compact")
+def compact() -> None:
+    """ Drop entries that have since been removed from the local event history, then rebuild
+    the local state from it. Syncs drop them too, whenever they merge in the backup.
+    """
+    if not LOCAL_EVENT_HISTORY.exists():
+        typer.echo("Status: No local event history to compact.")
+        return
+
+    before, after = backup.compact_event_history(LOCAL_EVENT_HISTORY)
+    backup.update_state_from_local_event_history()
+
+    typer.echo(f"Success: Compacted the local event history from {before} to {after} events.")
+    if access.get_state('SYNC_SETUP') == 'SUCCESS':
+        typer.echo("Note: The backup's segments are never rewritten, so they keep the removed entries, but every sync drops them again when merging.")
+
+@app.command(name="event")
+def show_event(event_uuid : str) -> None:
+    """ Look up an event (e.g. an entry's ADD_ENTRY event) in the local event history by its id. """
+    found = backup.find_event(LOCAL_EVENT_HISTORY, event_uuid)
+
+    if found is None:
+        typer.echo(f"No event found with id: {event_uuid}")
+        raise typer.Exit(1)
+
+    event, offset = found
+    typer.echo(f"{fmt_date(event['ts'])} [byte {offset}]: {json.dumps(event)}")
+
+@app.command(name="convert-log")
+def convert_log(
+    fmt: str = typer.Argument(..., help="Format to convert the local event history to", click_type=click.Choice([backup.JSONL, backup.BINARY])),
+) -> None:
+    """ Convert the local event history between the JSONL and compact binary formats.
+    The format is detected automatically when the history is read, or appended to.
+    """
+    try:
+        count = backup.convert_event_history(LOCAL_EVENT_HISTORY, LOCAL_EVENT_HISTORY, fmt)
+    except Exception as exc:
+        logging.error(f"Failed to convert the local event history: {exc}")
+        raise typer.Exit(1)
+
+    typer.echo(f"Success: Converted {count} events to the {fmt} format.")
+
 @app.command(name="set-pat")
 def set_pat(pat: str = typer.Argument(..., help="Your GitHub Personal Access Token")):
     """
@@ -233,7 +576,7 @@ def set_pat(pat: str = typer.Argument(..., help="Your GitHub Personal Access Tok
     Usage: lc-track set-pat <PAT>
     """
     try:
-        with access.get_db_connection() as con:
+        with access.transaction() as con:
             access.set_state(con, 'PAT', pat)
 
     except Exception as exc:
@@ -257,6 +600,8 @@ def setup_backup():
         """
     )
 
+    import github
+
     # 1. Inputs
     repo_name = typer.prompt("Backup repository name")
     pat = typer.prompt("GitHub Personal Access Token", hide_input=True)
@@ -270,7 +615,7 @@ def setup_backup():
         typer.echo(f"Connected: Authenticated as {username}")
     except github.BadCredentialsException:
         typer.echo("Error: Invalid PAT. Please verify your token and try again.") 
-        with access.get_db_connection() as con:
+        with access.transaction() as con:
             access.set_state(con, 'SYNC_SETUP', 'FAILURE')
         raise typer.Exit(1)
 
@@ -280,7 +625,7 @@ def setup_backup():
         typer.echo(f"Connected: Found {repo_name} repository")
     except github.UnknownObjectException:
         typer.echo(f"Error: Repository '{repo_name}' not found. Check name and PAT scopes.")
-        with access.get_db_connection() as con:
+        with access.transaction() as con:
             access.set_state(con, 'SYNC_SETUP', 'FAILURE')
         raise typer.Exit(1) 
     
@@ -288,14 +633,14 @@ def setup_backup():
     permissions = repo.permissions
     if not (permissions.push and permissions.pull):
         typer.echo("Error: PAT has insufficient permissions (Read/Write required)")
-        with access.get_db_connection() as con:
+        with access.transaction() as con:
             access.set_state(con, 'SYNC_SETUP', 'FAILURE')
         raise typer.Exit(1)
     
     typer.echo("Connected: Read and Write access confirmed")
 
     # 6. Finalize
-    with access.get_db_connection() as con:
+    with access.transaction() as con:
         access.set_state(con, 'PAT', pat)
         access.set_state(con, 'BACKUP_REPO_NAME', repo_name)
         access.set_state(con, 'USERNAME', username)
@@ -303,18 +648,46 @@ def setup_backup():
     
     typer.echo("Success: Sync configuration saved")
 
+def remote_head(repo) -> Optional[str]:
+    """ The commit the remote's HEAD points to, from a single `git ls-remote` round trip. """
+    out = repo.git.ls_remote("origin", "HEAD")
+    return out.split()[0] if out else None
+
+def upstream_head(repo) -> Optional[str]:
+    """ The commit of the local copy of the remote branch, as of the last pull / push. """
+    import git
+
+    try:
+        return repo.git.rev_parse("@{u}")
+    except git.GitCommandError: # No upstream branch configured
+        return None
+
+def is_ahead_of_upstream(repo) -> bool:
+    import git
+
+    try:
+        return repo.git.rev_list("--count", "@{u}..HEAD") != "0"
+    except git.GitCommandError:
+        return False
+
 @app.command(name="sync")
-def sync():
+def sync(
+    merge_logs: Optional[List[Path]] = typer.Option(None, "--merge-log", help="Additional event history (e.g. from another device) to merge in. Repeatable."),
+    compact: bool = typer.Option(False, "--compact", help="Merge even without new remote events, so removed entries are dropped from the local history (see `lc-track compact`)."),
+):
     """
     Synchronises the local event history with the remote backup repository.
 
     Performs a bidirectional sync sync:
     1. Fetches and pulls the latest history from the remote GitHub repository
-    2. Merges local and remote event logs to create a unified history.
-    3. Push the combined history back to the remote repository
-    4. Replays the unified event log to rebuil the local SQLite database.
+    2. Pushes the local events that aren't backed up yet, as a new (immutable) segment of the backup
+    3. Merges the local event log with every segment of the backup (plus any --merge-log files) to create a unified history,
+       dropping removed entries (the segments are never rewritten, so they still hold them).
+    4. Replays the unified event log (only the new events, where possible) to update the local SQLite database.
     """
     
+    import git
+
     # 1. Configuration Check
     if access.get_state('SYNC_SETUP') != 'SUCCESS':
         typer.echo("Error: Sync not configured. Run `lc-track setup-backup` first.")
@@ -353,33 +726,94 @@ def sync():
             typer.echo(f"Failed to handle initialisation of empty repository:\n\t{exc}")
             raise typer.Exit(1)
 
+    # Events may refer to any problem, so a partial catalogue (see main) is completed first
+    if access.get_state("initial_sync") != "complete":
+        typer.echo("Setup: Fetching the complete problem catalogue from leetcode.com...")
+        if utility.refresh_catalogue(full=True) is None:
+            typer.echo("Error: Failed to fetch the problem catalogue, which sync needs to replay events for any problem.")
+            raise typer.Exit(1)
+
     # 4. The Sync Process
     try:
+        # Nothing to do if neither side has changed since the last sync
+        with trace.span("check"):
+            backed_up = backup.get_event_history_checkpoint(backup.BACKUP_CHECKPOINT)
+            local_changed = not backup.is_event_history_unchanged(LOCAL_EVENT_HISTORY, backed_up)
+            head = remote_head(repo)
+            remote_changed = head is None or head != access.get_state(backup.SYNC_REMOTE_HEAD)
+
+        # The replay checkpoint guards against a previous sync that failed before its rebuild finished
+        db_stale = backup.get_replay_checkpoint() != backed_up
+
+        if not (local_changed or remote_changed or db_stale or merge_logs or compact or is_ahead_of_upstream(repo)):
+            typer.echo("Done: Nothing has changed since the last sync. Local state and remote state are up to date.")
+            return
+
         # Step 1: Pull
-        typer.echo("Sync [1/4]: Fetching latest remote history...")
-        repo.remotes.origin.pull()
-
-        # Step 2: Merge logic
-        typer.echo("Sync [2/4]: Merging local and backup event logs...")
-        event_history = backup.merge_event_histories(BACKUP_EVENT_HISTORY, LOCAL_EVENT_HISTORY)
-
-        # Atomic writes to both destinations
-        for target_path in [BACKUP_EVENT_HISTORY, LOCAL_EVENT_HISTORY]:
-            backup.write_event_history(TMP_EVENT_HISTORY, event_history)
-            TMP_EVENT_HISTORY.replace(target_path)
-
-        # Step 3: Push back to Cloud
-        typer.echo("Sync [3/4]: Uploading synchronised history to GitHub...")
-        repo.index.add([BACKUP_EVENT_HISTORY.name]) # Use .name if it's a Path object
-        if repo.is_dirty():
-            repo.index.commit("Sync: Combined local and remote histories")
-            repo.remotes.origin.push()
+        if remote_changed:
+            typer.echo("Sync [1/4]: Fetching latest remote history...")
+            with trace.span("git pull"):
+                repo.remotes.origin.pull()
+        else:
+            typer.echo("Sync [1/4]: Remote unchanged since the last sync, skipping fetch.")
+
+        # Step 2: Push the new events to the cloud, as a new segment of the backup
+        typer.echo("Sync [2/4]: Uploading new local events to GitHub...")
+        fmt = backup.detect_event_history_format(LOCAL_EVENT_HISTORY)
+        local_checkpoint = backup.checkpoint_event_history(LOCAL_EVENT_HISTORY)
+        new_events = backup.unbacked_up_events(*(merge_logs or []))
+
+        if new_events:
+            with trace.span("git commit"):
+                paths = backup.write_backup_segment(new_events, fmt)
+                repo.index.add([str(x) for x in paths])
+                repo.index.commit(f"Sync: {len(new_events)} new events from device {backup.get_device_id()}")
+
+            # The events are in a committed segment now, so even if the push below fails (and is
+            # retried by the next sync), they mustn't be written to another segment
+            with access.transaction() as con:
+                access.set_state(con, backup.BACKUP_CHECKPOINT, backup.fmt_replay_checkpoint(local_checkpoint))
+
+        if new_events or is_ahead_of_upstream(repo): # Includes commits left by a failed push
+            with trace.span("git push"):
+                repo.remotes.origin.push()
         else:
             typer.echo("Status: Remote already up to date.")
 
+        # Step 3: Merge logic. Without new remote events (or extra logs), the local log already
+        # holds the whole backup. The segments still hold the ADD_ENTRY of every removed entry, so
+        # they are always dropped, or every merge would bring back what was compacted away.
+        if remote_changed or merge_logs or compact:
+            typer.echo("Sync [3/4]: Merging local and backup event logs...")
+            backup.merge_event_histories(
+                *backup.backup_segment_paths(), LOCAL_EVENT_HISTORY, *(merge_logs or []),
+                dest=TMP_EVENT_HISTORY, fmt=fmt, drop_cancelled=True
+            )
+
+            # Atomic write, unless the merge didn't change anything
+            if backup.checkpoint_event_history(TMP_EVENT_HISTORY) == backup.checkpoint_event_history(LOCAL_EVENT_HISTORY):
+                TMP_EVENT_HISTORY.unlink()
+                typer.echo("Status: Local event log already up to date.")
+            else:
+                backup.publish_event_history(TMP_EVENT_HISTORY, [LOCAL_EVENT_HISTORY])
+        else:
+            typer.echo("Sync [3/4]: No new remote events, skipping merge.")
+
         # Step 4: Database Rebuild
-        typer.echo("Sync [4/4]: Rebuilding local database state from event history...")
-        backup.update_state_from_local_event_history()
+        typer.echo("Sync [4/4]: Updating local database state from event history...")
+        checkpoint = backup.checkpoint_event_history(LOCAL_EVENT_HISTORY)
+        if backup.get_replay_checkpoint() == checkpoint:
+            typer.echo("Status: Local database already up to date.")
+        elif backup.sync_state_from_local_event_history():
+            typer.echo("Status: Replayed new events only.")
+        else:
+            typer.echo("Status: Rebuilt local database state from the full event history.")
+
+        # Record that everything up to here is backed up and replayed, and which remote commit it
+        # was synced with. Only once the rebuild has succeeded, so a failed one is retried.
+        with access.transaction() as con:
+            access.set_state(con, backup.BACKUP_CHECKPOINT, backup.fmt_replay_checkpoint(checkpoint))
+            access.set_state(con, backup.SYNC_REMOTE_HEAD, upstream_head(repo) or "")
 
         typer.echo("Done: Sync successful. Local state and remote state are now up to date.")
 
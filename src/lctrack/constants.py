@@ -1,10 +1,12 @@
+import os
 from platformdirs import PlatformDirs
 from pathlib import Path
 
 dirs = PlatformDirs('lc-track','lc-track')
 
 def get_data_dir() -> Path:
-    data_dir = Path(dirs.user_data_dir)
+    # LCTRACK_DATA_DIR overrides the platform default (e.g. for benchmarks against a scratch directory)
+    data_dir = Path(os.environ.get("LCTRACK_DATA_DIR") or dirs.user_data_dir)
     data_dir.mkdir(parents=True, exist_ok=True)
     return data_dir
 
@@ -22,10 +24,22 @@ LOCAL_EVENT_HISTORY = DATA_DIR / "event_history_local.jsonl"
 
 # The directory to which the backup / sync github repo is cloned in to
 BACKUP_REPO_DIR = get_backup_repo_dir()
+# The backup before it was split into segments; still read, but never written to
 BACKUP_EVENT_HISTORY = BACKUP_REPO_DIR / "event_history_backup.jsonl"
+# Immutable segments of the backed up history, one directory (with a manifest) per device
+BACKUP_SEGMENTS_DIR = BACKUP_REPO_DIR / "segments"
 
 TMP_EVENT_HISTORY = DATA_DIR / "tmp_event_history.jsonl"
 
+# Snapshots of the state derived from LOCAL_EVENT_HISTORY, so a rebuild only has to replay the
+# events after the latest one (see backup.write_state_snapshot)
+STATE_SNAPSHOT_DIR = DATA_DIR / "snapshots"
+
+# A compressed snapshot of the LC250 problems, shipped with the package and loaded into a new
+# database. It is only a subset of the leetcode.com catalogue, without topics: the complete
+# catalogue is fetched by refresh-catalogue (or sync)
+CATALOGUE_SNAPSHOT = Path(__file__).with_name("catalogue.csv.gz")
+
 
 
 
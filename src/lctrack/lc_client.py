@@ -1,83 +1,132 @@
+import os
+import time
+import random
 import requests
 import logging
+import threading
 
-from typing import Any, Dict, Tuple, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Tuple, List, Optional
+
+from . import trace
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 ALL_PROBLEMS_URL = "https://leetcode.com/api/problems/all/"
-GRAPHQL_ENDPOINT = "https://leetcode.com/graphql"
+# LCTRACK_GRAPHQL_URL points the client at another server (e.g. the stand-in under benchmarks/)
+GRAPHQL_ENDPOINT = os.environ.get("LCTRACK_GRAPHQL_URL", "https://leetcode.com/graphql/")
+
+PAGE_SIZE = 100
+MAX_WORKERS = 8 # Concurrent page requests
+MAX_RETRIES = 4 # Per page, on top of the first attempt
+BACKOFF_BASE = 0.5 # Seconds, doubled after each failed attempt
+TIMEOUT = 30 # Seconds
 
-session = requests.Session()
-session.headers.update({
+HEADERS = {
     "User-Agent": "Mozilla/5.0...",
     "Content-Type": "application/json",
     "Referer": "https://leetcode.com"
-})
-
-def fetch_all_problems() -> List[Dict[str, Any]]: 
-    url = "https://leetcode.com/graphql/"
-    limit = 100
-    skip = 0
-    
-    query = """
-    query problemsetQuestionList($categorySlug: String, $limit: Int, $skip: Int, $filters: QuestionListFilterInput) {
-      problemsetQuestionList: questionList(
-        categorySlug: $categorySlug
-        limit: $limit
-        skip: $skip
-        filters: $filters
-      ) {
-        totalNum
-        questions: data {
-          questionFrontendId
-          title
-          titleSlug
-          difficulty
-          topicTags {
-            name
-            slug
-          }
-        }
+}
+
+QUERY = """
+query problemsetQuestionList($categorySlug: String, $limit: Int, $skip: Int, $filters: QuestionListFilterInput) {
+  problemsetQuestionList: questionList(
+    categorySlug: $categorySlug
+    limit: $limit
+    skip: $skip
+    filters: $filters
+  ) {
+    totalNum
+    questions: data {
+      questionFrontendId
+      title
+      titleSlug
+      difficulty
+      topicTags {
+        name
+        slug
       }
     }
-    """
+  }
+}
+"""
+
+# requests.Session isn't guaranteed to be thread-safe, so each worker thread gets its own
+_local = threading.local()
 
-    all_questions = []
+def get_session() -> requests.Session:
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+        _local.session.headers.update(HEADERS)
+
+    return _local.session
+
+def fetch_page(skip : int, limit : int = PAGE_SIZE, url : str = GRAPHQL_ENDPOINT) -> Dict[str, Any]:
+    """ Fetches a single page of the problem set, retrying with exponential backoff (and
+    jitter) on failure.
+
+    Returns {'totalNum': int, 'questions': [...]}
+    """
     payload = {
-        "query" : query,
+        "query" : QUERY,
         "variables" : {"categorySlug": "", "skip": skip, "limit": limit, "filters": {}}
     }
-    total = None
 
-    logging.info("Fetching complete problem set from leetcode.com ...")
-    try:
-        while True:
-            payload['variables']['skip'] = skip
-            res = session.post(url, json=payload)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            res = get_session().post(url, json=payload, timeout=TIMEOUT)
             res.raise_for_status()
 
-            data = res.json()
+            data = res.json()['data']['problemsetQuestionList']
+            return {'totalNum': data['totalNum'], 'questions': data['questions']}
+
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+
+            delay = BACKOFF_BASE * 2 ** attempt * (1 + random.random())
+            logging.warning(f"Failed to fetch problems {skip}-{skip + limit} ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
 
-            if total is None:
-                total = data['data']['problemsetQuestionList']['totalNum'] # The total number of questions
-            
-            # Extract the problems in this batch
-            question_batch = data['data']['problemsetQuestionList']['questions']
-            all_questions.extend(question_batch)
+@trace.traced("fetch")
+def fetch_all_problems(url : str = GRAPHQL_ENDPOINT,
+                       page_size : int = PAGE_SIZE,
+                       max_workers : int = MAX_WORKERS,
+                       start : int = 0) -> Optional[List[Dict[str, Any]]]:
+    """ Fetches the complete problem set, or only the problems from position `start` onwards.
+    The first page gives the total number of problems, after which the remaining pages are
+    fetched concurrently and reassembled in order.
 
-            pct_complete = min(skip + limit, total) / total
-            logging.info(f"Progress: {min(skip + limit, total)}/{total} problems fetched ({pct_complete:.1%})")
+    Returns None if any page still fails after its retries.
+    """
+    if start:
+        logging.info(f"Fetching problems {start + 1} onwards from leetcode.com ...")
+    else:
+        logging.info("Fetching complete problem set from leetcode.com ...")
+    try:
+        first = fetch_page(start, page_size, url)
+        total = first['totalNum'] # The total number of questions
 
-            if skip + limit > total:
-                break
-                
-            skip += limit
+        pages : Dict[int, List[Dict[str, Any]]] = {start: first['questions']}
+        fetched = start + len(first['questions'])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(fetch_page, skip, page_size, url): skip
+                for skip in range(start + page_size, total, page_size)
+            }
+
+            for future in as_completed(futures):
+                pages[futures[future]] = future.result()['questions']
+
+                fetched += len(pages[futures[future]])
+                logging.info(f"Progress: {min(fetched, total)}/{total} problems fetched ({min(fetched, total) / total:.1%})")
 
     except Exception as e:
         logging.error(f"Failed to fetch problem set from leetcode.com: {e}")
         return None
-    
+
+    all_questions = [question for skip in sorted(pages) for question in pages[skip]]
     logging.info(f"{len(all_questions)} problems fetched.")
 
-    return all_questions
\ No newline at end of file
+    return all_questions
@@ -0,0 +1,173 @@
+"""
+Orders the active study set for review.
+
+Problems are ranked by how overdue they are, relative to their current interval (a problem a
+day late on a 1 day interval is more urgent than one a day late on a 30 day interval), then by
+EF (harder to remember first), then by difficulty. The ranking is done by SQLite, with a LIMIT,
+so only the problems that are actually shown are read into Python.
+
+It also forecasts the review load of the days ahead, from the current schedule alone or by
+simulating the reviews to come.
+"""
+
+import heapq
+import random
+import datetime
+import itertools
+from typing import Dict, List, Optional
+
+from .ds import Problem
+from . import access
+from . import sm2
+
+# Number of intervals a problem is overdue by (negative if it isn't due yet). Problems that have
+# never been reviewed (last_review_at is NULL, or 0 once their entries are removed) rank as just due.
+OVERDUE_RATIO = """
+    CASE WHEN COALESCE(last_review_at, 0) = 0 THEN 0.0
+    ELSE (:now - next_review_at) / MAX(I * 86400.0, 86400.0) END
+"""
+
+PRIORITY_ORDER = f"({OVERDUE_RATIO}) DESC, EF ASC, difficulty DESC, id ASC"
+
+# --plan picks from the this many times N highest priority problems, so that a seeded shuffle
+# has something to choose from, while staying proportional to N
+PLAN_CANDIDATES = 3
+# With a seed, the overdue ratio of each candidate is perturbed by up to +/- PLAN_JITTER
+PLAN_JITTER = 0.5
+
+def now_ts() -> int:
+    return int(datetime.datetime.now().timestamp())
+
+def count_due(now : Optional[int] = None) -> int:
+    con = access.get_db_connection()
+    return con.execute(
+        "SELECT COUNT(*) FROM problems WHERE active = 1 AND next_review_at <= ?",
+        (now_ts() if now is None else now,)
+    ).fetchone()[0]
+
+def review_queue(limit : Optional[int] = None, now : Optional[int] = None) -> List[Problem]:
+    """ The active problems due for review, highest priority first, at most limit of them. """
+    con = access.get_db_connection()
+    cur = con.execute(f"""
+        SELECT * FROM problems
+        WHERE active = 1 AND next_review_at <= :now
+        ORDER BY {PRIORITY_ORDER}
+        LIMIT :limit
+    """, {"now": now_ts() if now is None else now, "limit": -1 if limit is None else limit})
+
+    return [Problem.from_row(x) for x in cur.fetchall()]
+
+def random_due(now : Optional[int] = None) -> Optional[Problem]:
+    """ A uniformly random active problem that is due for review. """
+    con = access.get_db_connection()
+    row = con.execute("""
+        SELECT * FROM problems
+        WHERE active = 1 AND next_review_at <= ?
+        ORDER BY random()
+        LIMIT 1
+    """, (now_ts() if now is None else now,)).fetchone()
+
+    return Problem.from_row(row) if row else None
+
+def plan(n : int, seed : Optional[int] = None, now : Optional[int] = None) -> List[Problem]:
+    """ A queue of n problems for today's session: the due problems by priority, topped up with
+    the problems closest to being due. With a seed, the priorities are randomly (but
+    reproducibly) perturbed, so that problems of similar urgency are mixed up from day to day.
+    """
+    now = now_ts() if now is None else now
+
+    con = access.get_db_connection()
+    cur = con.execute(f"""
+        SELECT {OVERDUE_RATIO}, * FROM problems
+        WHERE active = 1
+        ORDER BY {PRIORITY_ORDER}
+        LIMIT :limit
+    """, {"now": now, "limit": n * PLAN_CANDIDATES})
+    candidates = cur.fetchall()
+
+    if seed is None:
+        chosen = candidates[:n]
+    else:
+        rng = random.Random(seed)
+        keyed = [(ratio + rng.uniform(-PLAN_JITTER, PLAN_JITTER), i) for i, (ratio, *_) in enumerate(candidates)]
+        chosen = [candidates[i] for _, i in heapq.nlargest(n, keyed)]
+
+    return [Problem.from_row(row[1:]) for row in chosen]
+
+# Used by forecast(simulate=True) when there is no review history to take the distribution from
+DEFAULT_CONFIDENCE_WEIGHTS = {1: 0.05, 2: 0.1, 3: 0.25, 4: 0.35, 5: 0.25}
+
+def start_of_day(ts : int) -> int:
+    """ Local midnight at the start of the day containing ts. """
+    day = datetime.datetime.fromtimestamp(ts).date()
+    return int(datetime.datetime.combine(day, datetime.time()).timestamp())
+
+def forecast(days : int, now : Optional[int] = None) -> List[int]:
+    """ The number of active problems falling due on each of the next `days` days (today first),
+    from their current next_review_at. Problems already overdue count towards today.
+    """
+    start = start_of_day(now_ts() if now is None else now)
+
+    con = access.get_db_connection()
+    cur = con.execute("""
+        SELECT MAX(0, (next_review_at - :start) / 86400) AS day, COUNT(*) FROM problems
+        WHERE active = 1 AND next_review_at < :end
+        GROUP BY day
+    """, {"start": start, "end": start + days * 86400})
+
+    counts = [0] * days
+    for day, count in cur:
+        counts[day] += count
+
+    return counts
+
+def confidence_weights() -> Dict[int, float]:
+    """ The distribution of confidences in the review history, or DEFAULT_CONFIDENCE_WEIGHTS if
+    there is none.
+    """
+    con = access.get_db_connection()
+    weights = dict(con.execute("SELECT confidence, COUNT(*) FROM entries GROUP BY confidence").fetchall())
+
+    return weights or DEFAULT_CONFIDENCE_WEIGHTS
+
+def simulate_forecast(days : int,
+                      weights : Optional[Dict[int, float]] = None,
+                      seed : Optional[int] = None,
+                      now : Optional[int] = None) -> List[int]:
+    """ Like forecast, but also counts the repeat reviews falling within the next `days` days: each
+    review is assumed to happen on the day it is due (today, if overdue), with a confidence drawn
+    from weights (by default, the distribution of the review history so far), and its next review
+    scheduled by SM2.
+
+    The simulation steps through every active problem at once, one review per round, so the number
+    of rounds is bounded by the number of reviews of the most frequently due problem.
+    """
+    now = now_ts() if now is None else now
+    start = start_of_day(now)
+    end = start + days * 86400
+
+    weights = confidence_weights() if weights is None else weights
+    rng = random.Random(seed)
+    confidences, cum_weights = list(weights), list(itertools.accumulate(weights.values()))
+
+    con = access.get_db_connection()
+    # [(n, EF, I, due)]
+    live = [list(x) for x in con.execute(
+        "SELECT n, EF, I, MAX(next_review_at, :now) FROM problems WHERE active = 1 AND next_review_at < :end",
+        {"now": now, "end": end}
+    )]
+
+    counts = [0] * days
+    while live:
+        qs = rng.choices(confidences, cum_weights=cum_weights, k=len(live))
+
+        for state, q in zip(live, qs):
+            n, EF, I, due = state
+            counts[(due - start) // 86400] += 1
+
+            n, EF, I = sm2.SM2(q, n, EF, I)
+            state[:] = n, EF, I, sm2.next_review_at(due, I)
+
+        live = [x for x in live if x[3] < end]
+
+    return counts
@@ -0,0 +1,188 @@
+"""
+Interactive session mode (`lc-track shell`).
+
+A single process keeps the database connection open, and the catalogue, topic map and due
+queue in memory, so each step of a study session costs a query or two rather than a fresh
+interpreter start. Any lc-track command can be typed as is (e.g. `details 1`), and `next`,
+`rate 0-5` and `skip` step through the due queue.
+"""
+
+import cmd
+import uuid
+import shlex
+import logging
+import datetime
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+import click
+import typer
+
+from . import access
+from . import scheduler
+from .cli import colours, fmt_date
+from .utility import INT_TO_DIFF
+
+class Shell(cmd.Cmd):
+    intro = (
+        "lc-track shell. `next` shows the next problem due, `rate 0-5` logs a review of it, `skip` "
+        "moves on without one.\nEvery lc-track command works too (e.g. `details 1`). `help` lists "
+        "the shell commands, `quit` leaves."
+    )
+    prompt = "lc-track> "
+
+    def __init__(self, app : click.Command):
+        super().__init__()
+        self.app = app
+
+        # id -> (slug, title, difficulty)
+        self.catalogue : Dict[int, Tuple[str, str, int]] = {}
+        # id -> topic titles
+        self.topics : Dict[int, List[str]] = {}
+        self.load_catalogue()
+
+        self.queue : Deque[int] = deque()
+        self.skipped : set = set()
+        self.load_queue()
+
+    def load_catalogue(self) -> None:
+        self.catalogue.clear()
+        self.topics.clear()
+        for id, slug, title, difficulty, topics in access.get_catalogue():
+            self.catalogue[id] = (slug, title, difficulty)
+            self.topics[id] = [x.split(":", 1)[1] for x in topics.split(";") if x]
+
+    def load_queue(self) -> None:
+        """ (Re)loads the due queue, most urgent first, leaving out problems skipped this session. """
+        self.queue = deque(x.id for x in scheduler.review_queue() if x.id not in self.skipped)
+
+    def fmt_problem(self, id : int) -> str:
+        _, title, difficulty = self.catalogue[id]
+        difficulty_txt = INT_TO_DIFF[difficulty]
+        return f"LC{id}. {title} [\033[{colours.get(difficulty_txt, '37')}m{difficulty_txt}\033[0m]"
+
+    def do_next(self, arg : str) -> None:
+        """next: show the most urgent problem due for review."""
+        if not self.queue:
+            typer.echo("No problems due for review. You're all caught up!")
+            return
+
+        id = self.queue[0]
+        typer.echo(f"\033[1;94mTo study:\033[0m {self.fmt_problem(id)}")
+        if self.topics.get(id):
+            typer.echo(f"{'Topics':<15}: {', '.join(self.topics[id])}")
+        typer.echo(f"{'Due':<15}: {len(self.queue)} problems left")
+
+    def do_rate(self, arg : str) -> None:
+        """rate N: log a review of the current problem with confidence N (0-5), then show the next."""
+        if not self.queue:
+            typer.echo("No problem to rate. You're all caught up!")
+            return
+
+        try:
+            confidence = int(arg)
+            if not 0 <= confidence <= 5:
+                raise ValueError
+        except ValueError:
+            typer.echo("Error: Usage: rate N, where N is a confidence from 0 to 5.")
+            return
+
+        id = self.queue[0]
+        now = int(datetime.datetime.now().timestamp())
+        try:
+            access.insert_entry(str(uuid.uuid4()), id, confidence, now)
+        except Exception as exc:
+            typer.echo(f"Error: Failed to log the review: {exc}")
+            return
+
+        # Only once the review is saved, so a failed one can be retried
+        self.queue.popleft()
+
+        problem = access.get_problem(id)
+        typer.echo(f"\033[1;94mLogged:\033[0m {self.fmt_problem(id)} {confidence}/5, next review {fmt_date(problem.next_review_at)}")
+
+        self.do_next("")
+
+    def do_skip(self, arg : str) -> None:
+        """skip: leave the current problem for the rest of the session, then show the next."""
+        if not self.queue:
+            typer.echo("No problem to skip. You're all caught up!")
+            return
+
+        self.skipped.add(self.queue.popleft())
+        self.do_next("")
+
+    def do_queue(self, arg : str) -> None:
+        """queue [N]: list the next N (default 10) problems in the session's due queue."""
+        limit = int(arg) if arg.strip().isdigit() else 10
+        typer.echo(f"\033[1;94mTo review:\033[0m {len(self.queue)} problems pending")
+        for id in list(self.queue)[:limit]:
+            typer.echo(self.fmt_problem(id))
+
+    def do_reload(self, arg : str) -> None:
+        """reload: reload the catalogue and the due queue (e.g. after changes from another process), un-skipping every problem."""
+        self.skipped.clear()
+        self.load_catalogue()
+        self.load_queue()
+        typer.echo(f"Reloaded: {len(self.catalogue)} problems, {len(self.queue)} due.")
+
+    def do_quit(self, arg : str) -> bool:
+        """quit: leave the shell."""
+        return True
+
+    do_exit = do_quit
+
+    def do_EOF(self, arg : str) -> bool:
+        typer.echo()
+        return True
+
+    def emptyline(self) -> None:
+        pass
+
+    def onecmd(self, line : str) -> bool:
+        """ Reports a command that fails, rather than letting it end the session. """
+        try:
+            return super().onecmd(line)
+        except Exception as e:
+            logging.error(f"{line}: {e}")
+            return False
+
+    def default(self, line : str) -> None:
+        """ Runs any other line as an lc-track command, in this process. """
+        try:
+            args = shlex.split(line)
+        except ValueError as e:
+            typer.echo(f"Error: {e}")
+            return
+
+        if args and args[0] == "shell":
+            typer.echo("Already in the shell.")
+            return
+
+        try:
+            self.app.main(args=args, prog_name="lc-track", standalone_mode=False)
+        except (click.exceptions.Abort, typer.Abort):
+            typer.echo("Aborted.")
+        except SystemExit:
+            pass
+        except Exception as e:
+            # Usage errors (click's, or those of the click bundled with newer typer releases)
+            # report themselves. Anything else ends the command, not the session.
+            if hasattr(e, "show"):
+                e.show()
+            else:
+                logging.error(f"{line}: {e}")
+
+        # The command may have changed the catalogue, active set or SM-2 states
+        if args and args[0] in CATALOGUE_COMMANDS:
+            self.load_catalogue()
+        if not (args and args[0] in READ_ONLY_COMMANDS):
+            self.load_queue()
+
+# Commands that can't change the due queue, so don't need it reloaded after them
+READ_ONLY_COMMANDS = {"ls-active", "ls-review", "details", "search", "stats", "forecast", "event", "--help"}
+# Commands that can change the catalogue
+CATALOGUE_COMMANDS = {"refresh-catalogue", "sync"}
+
+def run(app : click.Command) -> None:
+    Shell(app).cmdloop()
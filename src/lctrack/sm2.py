@@ -1,7 +1,20 @@
-from typing import Tuple
+from collections import Counter
+from importlib.util import find_spec
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+# numpy is optional, and speeds up SM2_entry_states on large inputs spread over many problems. It is only imported once the
+# numpy backend is actually used, as importing it would otherwise dominate CLI start up.
+HAVE_NUMPY = find_spec("numpy") is not None
 
 EASE_INIT = 2.5
 
+# The NumPy backend runs one step per entry of the longest group, over the entries of every group
+# at that position, so it only beats the pure-Python backend with many entries per step (many
+# short groups), and enough entries in all to pay for importing NumPy (~0.1 s). See
+# `python benchmarks/bench_sm2.py crossover`.
+NUMPY_MIN_ENTRIES = 500_000
+NUMPY_MIN_ENTRIES_PER_STEP = 500
+
 def SM2(q : int,
         n : int, 
         EF : float,
@@ -24,4 +37,123 @@ def SM2(q : int,
             EF = 1.3
         
         return n, EF, I
-        
+
+def next_review_at(last_review_at : int, I : float) -> int:
+    """ The unix ts at which a problem is next due, I days after its last review. """
+    return last_review_at + int(round(I * 86400))
+
+def _SM2_steps_numpy(problem_ids, confidences, record : bool = False):
+    """ Runs SM2 over every group of entries at once.
+
+    Returns the start and length of each group, the (n, EF, I) arrays of each group's final state,
+    and with record=True, the (n, EF, I) arrays of the state after each entry (else None).
+    """
+    import numpy as np
+
+    q = np.asarray(confidences, dtype=np.int64)
+
+    starts = np.flatnonzero(np.r_[True, problem_ids[1:] != problem_ids[:-1]])
+    lengths = np.diff(np.r_[starts, len(problem_ids)])
+
+    # Longest groups first, so the groups with an entry at step k are always a prefix
+    order = np.argsort(-lengths, kind="stable")
+    starts, lengths = starts[order], lengths[order]
+
+    n = np.zeros(len(starts), dtype=np.int64)
+    EF = np.full(len(starts), EASE_INIT)
+    I = np.zeros(len(starts))
+
+    if record:
+        entry_states = (np.zeros(len(q), dtype=np.int64), np.zeros(len(q)), np.zeros(len(q)))
+
+    # SM2 is sequential within a problem, so step through the k-th entry of every
+    # problem at once (the same arithmetic, in the same order, as SM2 itself)
+    n_active = len(starts)
+    for k in range(int(lengths[0])):
+        while lengths[n_active - 1] <= k:
+            n_active -= 1
+
+        idx = starts[:n_active] + k
+        qk = q[idx]
+        nk, EFk, Ik = n[:n_active], EF[:n_active], I[:n_active]
+
+        correct = qk >= 3
+        Ik[:] = np.where(correct, np.where(nk == 0, 1.0, np.where(nk == 1, 6.0, Ik * EFk)), 1.0)
+        nk[:] = np.where(correct, nk + 1, 0)
+        EFk[:] = np.maximum(EFk + (0.1 - (5 - qk) * (0.08 + (5 - qk) * 0.02)), 1.3)
+
+        if record:
+            entry_states[0][idx], entry_states[1][idx], entry_states[2][idx] = nk, EFk, Ik
+
+    return starts, lengths, (n, EF, I), entry_states if record else None
+
+def numpy_pays_off(problem_ids : Sequence[int]) -> bool:
+    """ Whether the NumPy backend is expected to beat the pure-Python one on the grouped entries. """
+    if not HAVE_NUMPY or len(problem_ids) < NUMPY_MIN_ENTRIES:
+        return False
+
+    # The groups are contiguous, so this counts the entries of each
+    longest = max(Counter(problem_ids).values())
+    return len(problem_ids) / longest >= NUMPY_MIN_ENTRIES_PER_STEP
+
+def SM2_entry_states(problem_ids : Sequence[int],
+                     confidences : Sequence[int],
+                     backend : Optional[str] = None) -> List[Tuple[int, float, float]]:
+    """ Applies SM2 to the entries of every problem in one pass, returning the state after
+    every entry: [(n, EF, I)], in the same order as the input arrays.
+
+    The arrays describe one entry per index, grouped by problem_id (each problem's entries
+    contiguous) and in chronological order within each group, see derive_entry_states().
+
+    backend : "numpy", "python" or None to pick NumPy only where it pays off (see numpy_pays_off).
+    Both backends give identical results.
+    """
+    if backend is None:
+        backend = "numpy" if numpy_pays_off(problem_ids) else "python"
+
+    if backend == "numpy":
+        if not HAVE_NUMPY:
+            raise RuntimeError("The numpy backend of SM2_entry_states requires numpy to be installed")
+        import numpy as np
+
+        problem_ids = np.asarray(problem_ids, dtype=np.int64)
+        if not len(problem_ids):
+            return []
+
+        *_, (n, EF, I) = _SM2_steps_numpy(problem_ids, confidences, record=True)
+        return list(zip(n.tolist(), EF.tolist(), I.tolist()))
+
+    elif backend == "python":
+        states = []
+
+        current = None
+        for problem_id, q in zip(problem_ids, confidences):
+            if problem_id != current:
+                n, EF, I = 0, EASE_INIT, 0
+                current = problem_id
+
+            n, EF, I = SM2(q, n, EF, I)
+            states.append((n, EF, I))
+
+        return states
+    else:
+        raise ValueError(f"Unexpected SM2_entry_states backend: {backend}")
+
+def derive_entry_states(entries : Iterable[Tuple[str, int, int, int]]) -> Tuple[List[Tuple[str, int, int, int, int, float, float]], List[Tuple[int, float, float, int, int, int]]]:
+    """ Replays the entries (id, problem_id, confidence, ts) of each problem in order of (ts, id),
+    to derive the SM-2 state after each entry, and so the state of each problem.
+
+    Returns ([(id, problem_id, confidence, ts, n, EF, I)], [(n, EF, I, last_review_at, next_review_at, problem_id)])
+    """
+    ordered = sorted(entries, key=lambda x : (x[1], x[3], x[0]))
+    if not ordered:
+        return [], []
+
+    entry_states = SM2_entry_states([x[1] for x in ordered], [x[2] for x in ordered])
+    rows = [(*entry, *state) for entry, state in zip(ordered, entry_states)]
+
+    # The state of each problem is that after its last entry
+    last = {x[1]: x for x in rows}
+    states = [(n, EF, I, ts, next_review_at(ts, I), problem_id) for _, problem_id, _, ts, n, EF, I in last.values()]
+
+    return rows, states
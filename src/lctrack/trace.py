@@ -0,0 +1,104 @@
+"""
+Lightweight phase timing for lc-track, enabled by `lc-track --profile ...` or by setting the
+LCTRACK_TRACE environment variable.
+
+Code marks its phases with `with trace.span("name"):` (or the `@trace.traced("name")` decorator).
+For every phase, the wall time, CPU time, number of SQL statements executed and bytes read /
+written are recorded, and `report()` prints them as a table. Spans nest, so a phase shows up as
+e.g. `sync/merge`. When tracing is off, a span costs a single flag check.
+"""
+
+import os
+import sys
+import time
+import functools
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+enabled = bool(os.environ.get("LCTRACK_TRACE"))
+
+_stack : List[str] = []
+# phase -> [calls, wall (s), cpu (s), sql statements, bytes read, bytes written]
+_phases : Dict[str, List[float]] = {}
+_sql_statements = 0
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+def count_statement(statement : str) -> None:
+    """ sqlite3 trace callback, installed by access.get_db_connection when tracing is enabled. """
+    global _sql_statements
+    _sql_statements += 1
+
+def io_counters() -> Tuple[Optional[int], Optional[int]]:
+    """ Returns the bytes read and written by this process so far (including sockets, excluding
+    child processes such as git), or (None, None) where /proc/self/io isn't available.
+    """
+    try:
+        with open("/proc/self/io", "rb") as f:
+            counters = dict(line.split(b":") for line in f.read().splitlines())
+        return int(counters[b"rchar"]), int(counters[b"wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+@contextmanager
+def span(name : str) -> Iterator[None]:
+    """ Records the enclosed block as the phase `name`, nested under any enclosing span. """
+    if not enabled:
+        yield
+        return
+
+    _stack.append(name)
+    phase = "/".join(_stack)
+    stats = _phases.setdefault(phase, [0, 0.0, 0.0, 0, 0, 0])
+
+    read, written = io_counters()
+    sql = _sql_statements
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        sql = _sql_statements - sql
+        read_after, written_after = io_counters()
+        _stack.pop()
+
+        stats[0] += 1
+        stats[1] += wall
+        stats[2] += cpu
+        stats[3] += sql
+        if read is not None:
+            stats[4] += read_after - read
+            stats[5] += written_after - written
+
+def traced(name : str) -> Callable:
+    """ Decorator form of span. """
+    def decorator(fn : Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def phases() -> Dict[str, List[float]]:
+    return _phases
+
+def report(file = sys.stderr) -> None:
+    """ Prints a table of the recorded phases, in the order they were first entered. """
+    if not _phases:
+        return
+
+    width = max(len("phase"), *(len(x) for x in _phases))
+    print(f"\n{'phase':<{width}} {'calls':>6} {'wall (ms)':>10} {'cpu (ms)':>10} {'sql':>7} {'read (KB)':>10} {'written (KB)':>12}", file=file)
+    for phase, (calls, wall, cpu, sql, read, written) in _phases.items():
+        print(
+            f"{phase:<{width}} {calls:>6} {wall * 1000:>10.1f} {cpu * 1000:>10.1f} {sql:>7} "
+            f"{read / 1024:>10.1f} {written / 1024:>12.1f}",
+            file=file
+        )
@@ -1,12 +1,14 @@
 from dataclasses import dataclass
+import io
+import re
+import csv
+import gzip
 import datetime
 import logging
 from pathlib import Path
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, Iterable
 
-from .constants import BACKUP_EVENT_HISTORY, LOCAL_EVENT_HISTORY
-from .sm2 import SM2
-from .lc_client import fetch_all_problems
+from .constants import BACKUP_EVENT_HISTORY, LOCAL_EVENT_HISTORY, CATALOGUE_SNAPSHOT
 from . import access
 
 
@@ -52,66 +54,234 @@ class Problem:
             active=bool(row[9])
         )
 
-def recalc_and_set_problem_state(problem_id: int) -> None:
-    """Recompute SM-2 state, last/next review from this problem's entries."""
-    # [(id, confidence, ts)]
-    entries: List[Tuple[str, int, int, int]] = access.get_all_entries_by_problem_id(problem_id)
+def parse_problem_set(problems_raw : List[Dict[str, Any]]) -> Tuple[List[Tuple[int, str, str, int]], List[Tuple[str, str]], List[Tuple[int, str]]]:
+    """ Converts problems, as fetched from leetcode.com, into rows for the problems, topics
+    and problem_topic tables.
+    """
+    problems = [
+        (int(x['questionFrontendId']), x['titleSlug'], x['title'], DIFF_TO_INT[x['difficulty']])
+        for x in problems_raw
+    ]
 
-    if not entries: # Reset to default state
-        now = int(datetime.datetime.now().timestamp())
-        n, EF, I = 0, 2.5, 0.0
-        last_review_at = 0
-        next_review_at = now
-        access.update_SM2_state(problem_id, n, EF, I, last_review_at, next_review_at)
-        return
+    topics = sorted({(t['slug'], t['name']) for p in problems_raw for t in p['topicTags']})
 
-    entries.sort(key=lambda x: x[3])  # ts asc
+    problem_topics = [(int(p['questionFrontendId']), t['slug']) for p in problems_raw for t in p['topicTags']]
 
-    n, EF, I = 0, 2.5, 0.0
-    last_ts = 0
-    for _, _, conf, ts in entries:
-        n, EF, I = SM2(conf, n, EF, I)
-        last_ts = ts
+    return problems, topics, problem_topics
 
-    last_review_at = last_ts
-    next_review_at = last_ts + int(round(I * 86400))
+def parse_timestamp(value : str) -> int:
+    """ A unix timestamp, or an ISO 8601 date / datetime in local time, as a unix timestamp. """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
 
-    access.update_SM2_state(problem_id, n, EF, I, last_review_at, next_review_at)
+    return int(datetime.datetime.fromisoformat(value).timestamp())
 
-def initial_sync() -> None:
-    problems_raw = fetch_all_problems()
-    
+def read_entry_rows(lines : Iterable[str], now : int) -> Tuple[List[Tuple[int, int, int]], List[str]]:
+    """ Parses csv rows of problem_id,confidence[,ts] (a header row is skipped), with ts
+    defaulting to now.
+
+    Returns the entries [(problem_id, confidence, ts)], and an error message for each invalid row.
+    """
+    entries, errors = [], []
+
+    for ln, row in enumerate(csv.reader(lines), 1):
+        row = [x.strip() for x in row]
+        if not row or not any(row) or row[0].startswith("#"):
+            continue
+        if ln == 1 and not row[0].isdigit(): # Header
+            continue
+
+        try:
+            if len(row) not in (2, 3):
+                raise ValueError(f"expected problem_id,confidence[,ts], got {len(row)} fields")
+
+            problem_id, confidence = int(row[0]), int(row[1])
+            if not 0 <= confidence <= 5:
+                raise ValueError(f"confidence must be between 0 and 5, got {confidence}")
+
+            ts = parse_timestamp(row[2]) if len(row) == 3 and row[2] else now
+            entries.append((problem_id, confidence, ts))
+
+        except ValueError as exc:
+            errors.append(f"line {ln}: {exc}")
+
+    return entries, errors
+
+def parse_id_args(args : Iterable[str]) -> List[int]:
+    """ Expands problem ids and inclusive ranges, e.g. ["1", "10-12", "7,8"] -> [1, 10, 11, 12, 7, 8]. """
+    ids = []
+    for arg in args:
+        for part in filter(None, arg.split(",")):
+            start, sep, end = part.partition("-")
+            if sep:
+                if int(end) < int(start):
+                    raise ValueError(f"Invalid range: {part}")
+                ids.extend(range(int(start), int(end) + 1))
+            else:
+                ids.append(int(part))
+
+    return ids
+
+def read_id_list(path : Path) -> List[int]:
+    """ The problem ids in a list file: one id per line, or rows in the LC250.csv layout (only
+    the leading id is read). Blank lines, comments (#) and a header row are skipped.
+    """
+    ids = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if row and row[0].strip().isdigit():
+                ids.append(int(row[0]))
+
+    return ids
+
+def parse_confidence_weights(spec : str) -> Dict[int, float]:
+    """ Parses a confidence distribution, e.g. "3:1,4:2,5:1" -> {3: 1.0, 4: 2.0, 5: 1.0}. """
+    weights = {}
+    for part in filter(None, spec.split(",")):
+        confidence, _, weight = part.partition(":")
+        confidence, weight = int(confidence), float(weight)
+        if not 0 <= confidence <= 5:
+            raise ValueError(f"confidence must be between 0 and 5, got {confidence}")
+        if weight < 0:
+            raise ValueError(f"weights can't be negative, got {weight}")
+        weights[confidence] = weights.get(confidence, 0.0) + weight
+
+    if not sum(weights.values()):
+        raise ValueError("expected at least one confidence with a positive weight, e.g. 3:1,4:2,5:1")
+
+    return weights
+
+def slugify(title : str) -> str:
+    """ Approximates leetcode.com's title -> slug mapping, e.g. "Pow(x, n)" -> "powx-n". """
+    slug = re.sub(r"[^a-z0-9 -]", "", title.lower())
+    return re.sub(r"[ -]+", "-", slug).strip("-")
+
+def read_problem_csv(path : Path) -> Tuple[List[Tuple[int, str, str, int]], List[Tuple[str, str]], List[Tuple[int, str]]]:
+    """ Reads a problem list in the LC250.csv layout: id,title,difficulty[,slug[,topics]], where
+    topics is a ';' separated list of topic_slug:topic_title pairs. Files ending in .gz are
+    decompressed on the fly.
+
+    Returns rows for the problems, topics and problem_topic tables, as parse_problem_set does.
+    """
+    opener = gzip.open if Path(path).suffix == ".gz" else open
+    problems, topics, problem_topics = [], set(), []
+    seen : Dict[int, str] = {} # id -> title
+
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+
+            # LC250.csv doesn't quote titles, so "Pow(x, n)" spans two fields
+            k = next(i for i in range(2, len(row)) if row[i].strip().capitalize() in DIFF_TO_INT)
+            row = [row[0], ",".join(row[1:k])] + row[k:]
+
+            id, title, difficulty = int(row[0]), row[1], DIFF_TO_INT[row[2].strip().capitalize()]
+            if id in seen:
+                raise ValueError(f"{path}: problem id {id} is listed more than once ({seen[id]!r} and {title!r})")
+            seen[id] = title
+
+            slug = row[3] if len(row) > 3 and row[3] else slugify(title)
+            problems.append((id, slug, title, difficulty))
+
+            for topic in filter(None, row[4].split(";") if len(row) > 4 else []):
+                topic_slug, topic_title = topic.split(":", 1)
+                topics.add((topic_slug, topic_title))
+                problem_topics.append((id, topic_slug))
+
+    return problems, sorted(topics), problem_topics
+
+def write_catalogue_snapshot(dest : Path) -> int:
+    """ Writes the catalogue in the database to dest, as a gzipped csv readable by read_problem_csv.
+    The output is byte-for-byte reproducible for the same catalogue.
+
+    Returns the number of problems written.
+    """
+    catalogue = access.get_catalogue()
+
+    with open(dest, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as gz:
+        with io.TextIOWrapper(gz, encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            for id, slug, title, difficulty, topics in catalogue:
+                writer.writerow((id, title, INT_TO_DIFF[difficulty].lower(), slug, topics))
+
+    return len(catalogue)
+
+def load_catalogue_snapshot(path : Path = CATALOGUE_SNAPSHOT) -> Optional[int]:
+    """ Bulk loads the bundled catalogue snapshot in a single transaction. The snapshot only
+    covers the LC250 problems, without topics, so it is marked as partial: refresh-catalogue (or
+    the next sync) fetches the complete catalogue.
+
+    Returns the number of problems loaded, or None if the snapshot couldn't be loaded.
+    """
     try:
-        problems = [
-            (x['questionFrontendId'], x['titleSlug'], x['title'], DIFF_TO_INT[x['difficulty']])
-            for x in problems_raw
-        ]
+        problems, topics, problem_topics = read_problem_csv(path)
+
+        with access.transaction() as con:
+            access.upsert_catalogue(con, problems, topics, problem_topics)
+            access.set_state(con, "initial_sync", "snapshot")
+
+    except Exception as e:
+        logging.error(f"Failed to load catalogue snapshot {path}: {e}")
+        return None
+
+    return len(problems)
 
-        topics = {(t['slug'], t['name']) for p in problems_raw for t in p['topicTags']}
+def initial_sync() -> Optional[int]:
+    """ Fills a new database with the bundled catalogue snapshot, without waiting on the network.
+    Only if the snapshot can't be loaded is the complete catalogue fetched from leetcode.com.
 
-        problem_topics = [(p['questionFrontendId'], t['slug']) for p in problems_raw for t in p['topicTags']]
+    Returns the number of problems loaded, or None if neither could be loaded.
+    """
+    count = load_catalogue_snapshot()
+    if count is not None:
+        return count
 
+    return refresh_catalogue(full=True)
+
+def refresh_catalogue(full : bool = False) -> Optional[int]:
+    """ Adds problems published since the catalogue was last synced, fetching only the pages
+    past the highest known problem id. With full=True the whole catalogue is fetched instead,
+    so changes to existing problems (titles, difficulty, topics) are picked up too.
+
+    Existing SM-2 state and active flags are left alone.
+
+    Returns the number of problems inserted or changed, or None if the refresh failed.
+    """
+    from .lc_client import fetch_all_problems, PAGE_SIZE # Pulls in requests, so only imported when needed
+
+    count, max_id = access.get_catalogue_extent()
+
+    # A bundled snapshot may be stale or partial, so it's always followed by a full refresh
+    full = full or access.get_state("initial_sync") != "complete"
+
+    # The problem set is ordered by id, so the new problems come after the `count` known
+    # ones. Start a page early in case problems have been removed / hidden since.
+    start = 0 if full else max(0, count - PAGE_SIZE)
+    problems_raw = fetch_all_problems(start=start)
+    if problems_raw is None:
+        return None
+
+    try:
+        problems, topics, problem_topics = parse_problem_set(problems_raw)
     except Exception as e:
         logging.error(f"Failed to parse problem set fetched from leetcode.com: {e}")
-        return
+        return None
+
+    if not full:
+        problems = [x for x in problems if x[0] > max_id]
+        problem_topics = [x for x in problem_topics if x[0] > max_id]
+        new_slugs = {x[1] for x in problem_topics}
+        topics = [x for x in topics if x[0] in new_slugs]
 
-    con = access.get_db_connection()
     try:
-        with con:
-            cur = con.cursor()
-            
-            stmt = "INSERT INTO problems (id, slug, title, difficulty) VALUES (?, ?, ?, ?);"
-            cur.executemany(stmt, problems)
-
-            stmt = "INSERT INTO topics (topic_slug, topic_title) VALUES (?, ?);"
-            cur.executemany(stmt, topics)
-
-            stmt = "INSERT INTO problem_topic (problem_id, topic_slug) VALUES (?, ?);"
-            cur.executemany(stmt, problem_topics)
-            
+        with access.transaction() as con:
+            changed = access.upsert_catalogue(con, problems, topics, problem_topics)
             access.set_state(con, "initial_sync", "complete")
-        
+
     except Exception as e:
-        logging.error(f"Failed to sync problem set with leetcode.com: {e}")
-    finally:
-        con.close()
+        logging.error(f"Failed to refresh problem set from leetcode.com: {e}")
+        return None
+
+    return changed